@@ -1,6 +1,5 @@
-from . import connect, MainWindow
+from . import MainWindow
 from .main import main, parser
 
 args = parser.parse_args()
-connect(mock=args.debug)
 main(MainWindow)
@@ -1,5 +1,6 @@
 import ctypes
 import multiprocessing
+import threading
 import time
 from pathlib import Path
 from typing import Literal
@@ -8,22 +9,80 @@ import numpy as np
 from PIL import Image
 import queue
 
+from . import processes, render, timing
 from .shared_ndarray import SharedNdarray
 
 
+def build_levels(volume: np.ndarray, levels: dict, cancel: threading.Event):
+    """Fill `levels` with the render.LOD_FACTORS levels of the scan `volume`, each from the previous one."""
+    source, previous = volume, 1
+    for factor in render.LOD_FACTORS:
+        level = []
+        for phase in source:
+            if cancel.is_set():
+                return
+            level.append(render.pool(phase, factor // previous))
+        levels[factor] = source = np.stack(level)
+        previous = factor
+
+
+def draw(request, volume, planes: render.PlaneCache, pool, timings: timing.Ring = timing.OFF,
+         levels: dict = None) -> Image.Image:
+    """The frame for `request`: all the phases of its layout go through one stacked pass.
+
+    A request with `lod` set is drawn from the coarsest of the `levels` built so far, if any.
+    """
+    phases = render.layout_phases(request.layout, request.phase)
+    factor = max(levels or (), default=1) if getattr(request, "lod", False) else 1
+    resample = request.resample
+    with timings.stage("base.slice"):
+        if volume is None:
+            stack = np.random.randint(0, 256, (len(phases), 512, 512)).astype(np.int16)
+            request_box = request.box
+        elif factor > 1:
+            index, factors = render.level_view(request.plane, request.z, factor, request.swap_xy)
+            stack = np.stack([
+                planes.plane((request.handle, factor), levels[factor], phase, request.plane, index)
+                for phase in phases
+            ])
+            request_box = render.scale_box(request.box, factors)
+            resample = "bilinear"  # upsampling a coarse slice: the wider filters would only cost time
+        else:
+            stack = np.stack([
+                planes.plane(request.handle, volume.as_numpy, phase, request.plane, request.z)
+                for phase in phases
+            ])
+            request_box = request.box
+        stack = render.orient(stack, request.swap_xy, request.flip_x, request.flip_y)
+        stack, box = render.crop(stack, request_box)
+    with timings.stage("base.window"):
+        stack = render.apply_windows(stack, [request.windows[phase] for phase in phases])
+    tile_pool = pool if request.tiled else None
+
+    with timings.stage("base.resize"):
+        if request.layout in render.GRID_LAYOUTS:
+            imgs = [Image.fromarray(slice).convert('RGB') for slice in stack]
+            return render.compose(imgs, request.layout, request.resolution, resample, tile_pool, box)
+        if request.layout in render.BLEND_LAYOUTS:
+            img = Image.fromarray(render.blend(stack, request.layout))
+        else:
+            img = Image.fromarray(stack[0]).convert('RGB')
+        return render.resize(img, request.resolution, resample, tile_pool, box)
+
+
 class Worker:
     def __init__(
             self,
             request_queue: multiprocessing.Queue,
             return_queue: multiprocessing.Queue, 
-            data: np.ndarray,
+            timings: timing.Ring = timing.OFF,
             ):
-        self._is_alive = multiprocessing.Value(ctypes.c_bool, True)
+        self._is_alive = processes.context().Value(ctypes.c_bool, True)
         self.request_queue = request_queue
         self.return_queue = return_queue
-        self.data = data
+        self.timings = timings
 
-        self._process = multiprocessing.Process(target=self.run)
+        self._process = processes.context().Process(target=self.run)
         self._process.start()
 
 
@@ -45,30 +104,44 @@ class Worker:
     is_alive = property(get_is_alive, set_is_alive)
 
     def run(self):
+        volumes = {}
+        pyramids = {}  # handle: (levels, cancel event of the thread building them)
+        planes = render.PlaneCache()
+        pool = render.tile_pool()
         while self.is_alive:
             request = None
+            wait = 0.5  # block for the first message only, then drain what is queued
             while True:
                 try:
-                    request = self.request_queue.get_nowait()
+                    message = self.request_queue.get(timeout=wait) if wait else self.request_queue.get_nowait()
                 except queue.Empty:
                     break
-            if request:
-                if self.data is None:
-                    slice = np.random.randint(0, 256, (512, 512)).astype(np.uint8)
+                wait = 0
+                if hasattr(message, "open"):
+                    volumes[message.open] = message.scan
+                    pyramids[message.open] = ({}, threading.Event())
+                    threading.Thread(
+                        target=build_levels, args=(message.scan.as_numpy, *pyramids[message.open]), daemon=True,
+                    ).start()
+                elif hasattr(message, "close"):
+                    block = volumes.pop(message.close, None)
+                    levels, cancel = pyramids.pop(message.close, ({}, threading.Event()))
+                    cancel.set()
+                    planes.forget(message.close)
+                    if block is not None:
+                        block.close()
                 else:
-                    slice = np.uint8(self.data[request.phase, :, :, request.z])
-                if request.swap_xy:
-                    slice = slice.transpose()
-                if request.flip_x:
-                    slice = np.flip(slice, axis=0)
-                if request.flip_y:
-                    slice = np.flip(slice, axis=1)
-
-                img = Image.fromarray(slice).convert('RGB').resize(
-                    (request.resolution, request.resolution))
+                    request = message
+            if request:
+                sent = getattr(request, "sent", None)
+                if sent is not None:
+                    self.timings.record(
+                        "base.queue", sent, time.perf_counter() - sent, timing.depth(self.request_queue))
+                levels = pyramids.get(request.handle, ({},))[0]
+                img = draw(request, volumes.get(request.handle), planes, pool, self.timings, levels)
+                # Image.info is pickled with the image: it takes the request time back for the latency.
+                img.info["sent"] = sent
                 self.return_queue.put(img, timeout=5)
-            else:
-                time.sleep(0.5)
     
     def stop(self):
         self.is_alive = False
@@ -0,0 +1,160 @@
+"""Apply segmentation edits to every case under a folder, headless and in parallel.
+
+    python -m frontend_liver.batch ROOT flip=0 translate=-2 mask=prediction.nii.gz:2
+
+Operations run in the given order, with the edit functions of the overlay worker:
+    flip=AXIS               flip along axis 0, 1 or 2
+    translate=DELTA         move by DELTA planes along z
+    mask=FILE:INDEX         set label INDEX where the nifti FILE of the case is set
+
+A case is a folder with segmentation.nii.gz and registration_data.pickle (a Drive mirror, the case
+cache). Every finished case goes in a journal, by path relative to ROOT, with the md5 of its output; a
+rerun with the same operations skips the cases whose segmentation still has that md5, so a batch resumes
+after failures or interruptions.
+"""
+import argparse
+import json
+import os
+import time
+import traceback
+from pathlib import Path
+
+import numpy as np
+
+from . import nibabel_utils as nu
+from . import over_draw_process, processes
+
+OPERATIONS = ("flip", "translate", "mask")
+# Left in each case folder with the operations applied and the md5 of the result.
+MARKER = "batch_output.json"
+
+
+def parse_operation(text: str) -> tuple:
+    name, _, arg = text.partition("=")
+    if name not in OPERATIONS or not arg:
+        raise argparse.ArgumentTypeError(f"{text!r} is not one of {', '.join(o + '=...' for o in OPERATIONS)}")
+    if name == "mask":
+        file, _, index = arg.rpartition(":")
+        return name, file, int(index)
+    return name, int(arg)
+
+
+def iter_cases(root: Path):
+    """Case folders under `root` that hold a segmentation and its registration data."""
+    for path in sorted(root.rglob("registration_data.pickle")):
+        if (path.parent / "segmentation.nii.gz").exists():
+            yield path.parent
+
+
+def apply(operation: tuple, segm: np.ndarray, case_path: Path) -> np.ndarray:
+    name, *args = operation
+    if name == "flip":
+        return over_draw_process.flip(segm, args[0])
+    if name == "translate":
+        return over_draw_process.translate(segm, args[0])
+    file, index = args
+    return over_draw_process.merge_mask(segm, nu.load_ndarray(case_path / file), index)
+
+
+def process(case_path: Path, name: str, operations: list, key: str, previous: str = None) -> dict:
+    """Load, edit and save the segmentation of one case; runs in a pool process.
+
+    A case whose segmentation.nii.gz is already the output of these operations, by the md5 in the journal
+    (`previous`) or in the marker left next to it, is not edited again.
+    """
+    start = time.perf_counter()
+    try:
+        marker = case_path / MARKER
+        if marker.exists():
+            with open(marker) as f:
+                last = json.load(f)
+            if last["operations"] == key:
+                previous = previous or last["md5"]
+        if previous is not None and nu.file_md5(case_path / "segmentation.nii.gz") == previous:
+            return dict(case=name, status="done", md5=previous, skipped=True, seconds=time.perf_counter() - start)
+        segm = nu.load(case_path, scan=False, segm=True)["segm"]
+        if segm is None:
+            raise FileNotFoundError(f"no usable segmentation in {case_path}")
+        segm = np.uint8(segm)
+        for operation in operations:
+            segm = apply(operation, segm, case_path)
+        path, md5 = nu.stream_segmentation(lambda lo, hi: segm[..., lo:hi], segm.shape, case_path)
+        # Right away, so that a crash before the journal is written does not apply the edits twice on resume.
+        with open(marker, "w") as f:
+            json.dump(dict(operations=key, md5=md5), f)
+        nu.patch_path(case_path).unlink(missing_ok=True)
+        return dict(case=name, status="done", md5=md5, seconds=time.perf_counter() - start)
+    except Exception as err:
+        traceback.print_exc()
+        return dict(case=name, status="failed", error=repr(err), seconds=time.perf_counter() - start)
+
+
+def limit_memory(gigabytes: float):
+    """Pool initializer: a process that allocates past the limit fails with MemoryError instead of swapping."""
+    if gigabytes:
+        import resource  # Not on Windows, where main refuses --memory.
+        size = int(gigabytes * 2 ** 30)
+        resource.setrlimit(resource.RLIMIT_AS, (size, size))
+
+
+def done_cases(journal: Path, key: str) -> dict:
+    """Output md5 of the cases done with the operations `key`, by case path relative to the root."""
+    if not journal.exists():
+        return {}
+    with open(journal) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    return {
+        entry["case"]: entry["md5"] for entry in entries if entry["operations"] == key and entry["status"] == "done"}
+
+
+def run(root: Path, operations: list, journal: Path, workers: int, tasks_per_worker: int, memory: float) -> list:
+    root = root.resolve()
+    key = " ".join(":".join(map(str, operation)) for operation in operations)
+    done = done_cases(journal, key)
+    # Every case goes to the pool: the ones done are only checked, by md5, and skipped.
+    names = {case: case.relative_to(root).as_posix() for case in iter_cases(root)}
+    jobs = [(case, name, operations, key, done.get(name)) for case, name in names.items()]
+    print(f"{len(jobs)} cases, {sum(job[-1] is not None for job in jobs)} already done.")
+    results = []
+    # Cases go out one at a time, so at most `workers` segmentations are in memory, and every
+    # process is replaced after `tasks_per_worker` cases, so that its heap does not creep up.
+    with processes.context().Pool(workers, limit_memory, (memory,), maxtasksperchild=tasks_per_worker) as pool, \
+            open(journal, "a") as f:
+        for i, result in enumerate(pool.imap_unordered(_process, jobs, chunksize=1)):
+            result["operations"] = key
+            f.write(json.dumps(result) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+            results.append(result)
+            state = "skipped, already done" if result.get("skipped") else result["status"]
+            print(f"[{i + 1}/{len(jobs)}] {state} {result['case']} ({result['seconds']:.1f} s)")
+    return results
+
+
+def _process(job: tuple) -> dict:
+    return process(*job)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("root", type=Path)
+    parser.add_argument("operations", type=parse_operation, nargs="+")
+    parser.add_argument("--journal", type=Path, default=None, help="Default: ROOT/batch_journal.jsonl.")
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) - 1))
+    parser.add_argument("--tasks-per-worker", type=int, default=8, help="Cases before a pool process is replaced.")
+    parser.add_argument("--memory", type=float, default=None, help="Address space limit of each worker, in GB.")
+    args = parser.parse_args()
+    if args.memory and os.name == "nt":
+        parser.error("--memory needs resource limits, which Windows does not have.")
+
+    results = run(args.root, args.operations, args.journal or args.root / "batch_journal.jsonl",
+                  args.workers, args.tasks_per_worker, args.memory)
+    failed = [result for result in results if result["status"] != "done"]
+    print(f"{len(results) - len(failed)} done, {len(failed)} failed.")
+    for result in failed:
+        print("  ", result["case"], result["error"])
+    raise SystemExit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
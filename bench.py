@@ -0,0 +1,291 @@
+"""Headless benchmarks of the load, save, render, edit and discovery paths on synthetic cases.
+
+    python -m frontend_liver.bench --shape 512 512 120 --repeat 20 --only render edit
+
+Each benchmark runs in its own process, so that its peak RSS is its own.
+"""
+import argparse
+import json
+import multiprocessing
+import pickle
+import queue
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+PHASES = ["b", "a", "v", "t"]
+
+
+def synthetic_case(case_path: Path, shape: tuple, seed: int = 0):
+    """A case folder like the registered ones on Drive: noisy phases with a bright ball, labelled in the segmentation."""
+    import nibabel
+    case_path.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    x, y, z = np.ogrid[:shape[0], :shape[1], :shape[2]]
+    ball = ((x - shape[0] / 2) ** 2 + (y - shape[1] / 2) ** 2) / (shape[0] / 4) ** 2 \
+        + (z - shape[2] / 2) ** 2 / (shape[2] / 4) ** 2 < 1
+    affine = np.diag([0.8, 0.8, 2.5, 1.0])
+    for i, phase in enumerate(PHASES):
+        scan = rng.normal(40, 20, shape).astype(np.int16)
+        scan[ball] += 60 + 20 * i
+        nibabel.save(nibabel.Nifti1Image(scan, affine=affine), case_path / f"registered_phase_{phase}.nii.gz")
+    nibabel.save(nibabel.Nifti1Image(np.uint8(ball), affine=affine), case_path / "segmentation.nii.gz")
+    with open(case_path / "registration_data.pickle", "wb") as f:
+        pickle.dump(dict(affine=affine, bottom=0, top=shape[2], height=shape[2]), f)
+
+
+def result(name: str, durations: list, items: int = 1) -> dict:
+    """Throughput (items per second) and latency percentiles (ms) of `durations`, in seconds."""
+    durations = np.array(durations)
+    p50, p95, p99 = np.percentile(durations, [50, 95, 99]) * 1000
+    return dict(name=name, n=len(durations), throughput=items * len(durations) / durations.sum(),
+                p50=p50, p95=p95, p99=p99)
+
+
+def timed(fn, repeat: int) -> list:
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def drain(q: multiprocessing.Queue, timeout: float = 0.5):
+    while True:
+        try:
+            q.get(timeout=timeout)
+        except queue.Empty:
+            return
+
+
+def draw_request(shape: tuple, **kwargs) -> SimpleNamespace:
+    return SimpleNamespace(**dict(dict(
+        handle=0, flip_x=True, flip_y=False, swap_xy=True, resolution=800, resample="bicubic", tiled=False,
+        box=None, windows=[(127.5, 255)] * 4, layout="single", plane="axial", phase=2, z=shape[2] // 2,
+        sent=time.perf_counter(),
+    ), **kwargs))
+
+
+def bench_load(case_path: Path, shape: tuple, repeat: int) -> list:
+    import nibabel
+    from . import chunked
+    from . import nibabel_utils as nu
+    for path in case_path.glob("*.npy"):
+        path.unlink()
+    gz = timed(lambda: nu.load(case_path, scan=True, segm=True, dtype=np.int16), repeat)
+    decode = timed(lambda: nu.decode(case_path), 1)
+    npy = timed(lambda: nu.load(case_path, scan=True, segm=True, dtype=np.int16), repeat)
+    for path in case_path.glob("*.npy"):
+        path.unlink()
+    convert = timed(lambda: chunked.convert(case_path), 1)
+    chunks = timed(lambda: nu.load(case_path, scan=True, segm=True, dtype=np.int16), repeat)
+    planes = np.random.default_rng(0).integers(0, shape[2], repeat)
+    nifti = case_path / "registered_phase_v.nii.gz"
+    gz_plane = timed(lambda: nibabel.load(nifti).dataobj[..., planes[0]], repeat)
+    volume = chunked.ChunkedVolume(case_path, "scan", cache=0)
+    chunk_plane = [timed(lambda: volume.plane(z), 1)[0] for z in planes]
+    shutil.rmtree(chunked.chunks_path(case_path))
+    return [result("load nifti", gz), result("decode", decode), result("load decoded", npy),
+            result("convert to chunks", convert), result("load chunked", chunks),
+            result("plane from nifti", gz_plane), result("plane from chunks", chunk_plane)]
+
+
+def bench_save(case_path: Path, shape: tuple, repeat: int) -> list:
+    from . import nibabel_utils as nu
+    from .label_store import BlockLabels
+    segm = nu.load(case_path, scan=False, segm=True)["segm"].astype(np.uint8)
+    store = BlockLabels.from_dense(segm)
+    dense = timed(lambda: nu.save_segmentation(segm, case_path), repeat)
+    pickled = timed(lambda: pickle.dumps(store), repeat)
+    stream = timed(lambda: nu.stream_segmentation(
+        lambda start, stop: store.read((slice(None), slice(None), slice(start, stop))), store.shape, case_path), repeat)
+    return [result("save dense", dense), result("pickle label blocks", pickled), result("save streamed", stream)]
+
+
+def bench_render(case_path: Path, shape: tuple, repeat: int) -> list:
+    from . import base_draw_process, processes
+    from . import nibabel_utils as nu
+    from .shared_ndarray import SharedBlock
+    scan = SharedBlock.from_numpy(nu.load(case_path, scan=True, dtype=np.int16)["scan"])
+    requests, frames = processes.context().Queue(), processes.context().Queue()
+    worker = base_draw_process.Worker(requests, frames)
+    requests.put(SimpleNamespace(open=0, scan=scan))
+    results = []
+    try:
+        results.extend(render_loops(requests, frames, shape, repeat))
+    finally:
+        worker.stop()
+        drain(frames)
+        scan.unlink()
+    return results
+
+
+def render_loops(requests: multiprocessing.Queue, frames: multiprocessing.Queue, shape: tuple, repeat: int) -> list:
+    results = []
+    for name, kwargs in [
+        ("render axial", {}),
+        ("render axial tiled 1600px", dict(resolution=1600, tiled=True)),
+        ("render coronal", dict(plane="coronal")),
+        ("render quad layout", dict(layout="quad")),
+        ("render zoomed 4x", dict(box=(shape[0] * 3 / 8, shape[1] * 3 / 8, shape[0] * 5 / 8, shape[1] * 5 / 8))),
+        ("render axial while scrolling", dict(lod=True)),
+    ]:
+        durations = []
+        for i in range(repeat):
+            requests.put(draw_request(shape, **dict(dict(z=i % shape[2]), **kwargs)))
+            start = time.perf_counter()
+            frames.get(timeout=10)
+            durations.append(time.perf_counter() - start)
+        results.append(result(name, durations))
+    return results
+
+
+def bench_edit(case_path: Path, shape: tuple, repeat: int) -> list:
+    from . import nibabel_utils as nu
+    from . import over_draw_process, processes
+    from .shared_ndarray import SharedBlock
+    data = nu.load(case_path, scan=True, segm=True, dtype=np.int16)
+    scan = SharedBlock.from_numpy(data["scan"])
+    draws, edits, frames, saves = (processes.context().Queue() for _ in range(4))
+    worker = over_draw_process.Worker(draws, edits, frames, saves)
+    edits.put(SimpleNamespace(open=0, segm=data["segm"].astype(np.uint8), scan=scan))
+    try:
+        frames.get(timeout=10)
+        return edit_loops(draws, edits, frames, data["segm"], shape, repeat)
+    finally:
+        worker.stop()
+        drain(frames)
+        scan.unlink()
+
+
+def edit_loops(draws: multiprocessing.Queue, edits: multiprocessing.Queue, frames: multiprocessing.Queue,
+               segm: np.ndarray, shape: tuple, repeat: int) -> list:
+    def round_trip(message):
+        start = time.perf_counter()
+        edits.put(message)
+        frames.get(timeout=30)
+        return time.perf_counter() - start
+
+    def click(i, **kwargs):
+        return SimpleNamespace(
+            handle=0, event=SimpleNamespace(canvas_size=(800, 800), x=300 + i % 200, y=400), box=None,
+            swap_xy=True, flip_x=True, flip_y=False, plane="axial", z=shape[2] // 2, resolution=800, **kwargs,
+        )
+
+    results = []
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        draws.put(draw_request(shape, z=i % shape[2]))
+        frames.get(timeout=10)
+        durations.append(time.perf_counter() - start)
+    results.append(result("overlay render", durations))
+    for brush in [("circle", 5, 1.0), ("circle", 20, 1.0), ("sphere", 10, 1.0)]:
+        edits.put(SimpleNamespace(set_brush=brush))
+        results.append(result(f"brush {brush[0]} {brush[1]}", [round_trip(click(i)) for i in range(repeat)]))
+    results.append(result("region fill", [
+        round_trip(click(i, fill=40, extent=64, phase=2)) for i in range(repeat)]))
+    results.append(result("propagate 10 slices", [
+        round_trip(SimpleNamespace(handle=0, propagate=10, tolerance=40, phase=2, plane="axial", z=shape[2] // 2))
+        for _ in range(repeat)]))
+    results.append(result("flip", [round_trip(SimpleNamespace(handle=0, flipaxis=i % 3)) for i in range(repeat)]))
+    results.append(result("translate", [
+        round_trip(SimpleNamespace(handle=0, translate=1 - 2 * (i % 2))) for i in range(repeat)]))
+    mask = np.uint8(segm > 0)
+    results.append(result("mask", [
+        round_trip(SimpleNamespace(handle=0, mask=mask, shape=shape, index=2)) for _ in range(repeat)]))
+    return results
+
+
+def bench_discover(case_path: Path, shape: tuple, repeat: int, cases: int = 50) -> list:
+    from . import pydrive_utils as pu
+    root = case_path.parent / "drive"
+    for i in range(cases):
+        folder = root / "sources" / f"group_{i % 5}" / f"case_{i:04d}"
+        folder.mkdir(parents=True, exist_ok=True)
+        for name in [f"registered_phase_{phase}.nii.gz" for phase in PHASES] + ["segmentation.nii.gz"]:
+            (folder / name).touch()
+    pu.drive = pu.MockDrive(root)
+    sources = pu.DrivePath(["sources"], root="root")
+    durations = timed(lambda: list(pu.iter_trainable(sources)), repeat)
+    walked = timed(lambda: list(pu.walk(sources, pu.has_trainable)), repeat)
+    rows = [result(f"discover {cases} cases", durations, items=cases),
+            result(f"walk {cases} cases, 8 threads", walked, items=cases)]
+    # The same with every request taking as long as a round trip to Drive.
+    pu.drive = pu.MockDrive(root, latency=0.005)
+    rows.append(result(f"discover {cases} cases, 5 ms requests",
+                       timed(lambda: list(pu.iter_trainable(sources)), 1), items=cases))
+    rows.append(result(f"walk {cases} cases, 5 ms requests",
+                       timed(lambda: list(pu.walk(sources, pu.has_trainable)), repeat), items=cases))
+    return rows
+
+
+BENCHMARKS = {
+    "load": bench_load,
+    "save": bench_save,
+    "render": bench_render,
+    "edit": bench_edit,
+    "discover": bench_discover,
+}
+
+
+def peak_rss_mb() -> tuple:
+    """Peak RSS of this process and of its largest child, in MB, or None where it is not available."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None, None
+    # ru_maxrss is in kB, but in bytes on macOS.
+    unit = 2 ** 20 if sys.platform == "darwin" else 2 ** 10
+    return tuple(resource.getrusage(who).ru_maxrss / unit for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN])
+
+
+def run(name: str, case_path: Path, shape: tuple, repeat: int, results: multiprocessing.Queue):
+    try:
+        rows = BENCHMARKS[name](case_path, shape, repeat)
+    except Exception:
+        traceback.print_exc()
+        rows = []
+    peak, workers = peak_rss_mb()
+    results.put([dict(row, benchmark=name, peak_rss_mb=peak, worker_peak_rss_mb=workers) for row in rows])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shape", type=int, nargs=3, default=[512, 512, 120], help="Size of the synthetic case.")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--only", nargs="*", choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument("--json", type=str, default=None, help="Also write the results to this file.")
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        case_path = Path(tmpdir) / "case"
+        synthetic_case(case_path, tuple(args.shape))
+        for name in args.only:
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=run, args=(name, case_path, tuple(args.shape), args.repeat, results))
+            process.start()
+            rows.extend(results.get())
+            process.join()
+
+    print(f"{'benchmark':<32}{'n':>5}{'per s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'RSS MB':>10}")
+    for row in rows:
+        rss = "n/a" if row["peak_rss_mb"] is None else f"{max(row['peak_rss_mb'], row['worker_peak_rss_mb']):.0f}"
+        print(f"{row['name']:<32}{row['n']:>5}{row['throughput']:>10.1f}{row['p50']:>10.1f}{row['p95']:>10.1f}"
+              f"{row['p99']:>10.1f}{rss:>10}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import functools
+
+import numpy as np
+
+from . import render
+
+SHAPES = ("circle", "square", "sphere")
+
+# Ordered dither thresholds, so that a soft brush paints a deterministic fraction of its falloff ring.
+_BAYER = np.array([
+    [0, 8, 2, 10],
+    [12, 4, 14, 6],
+    [3, 11, 1, 9],
+    [15, 7, 13, 5],
+]) / 16 + 1 / 32
+
+
+@functools.lru_cache(maxsize=64)
+def kernel(shape: str = "circle", radius: int = 5, hardness: float = 1.0) -> np.ndarray:
+    """Read-only int8 mask of side 2 * radius + 1, with a leading z axis for the sphere. It is signed, so
+    that delete actions can subtract it.
+
+    The circle and the sphere keep the points closer than radius + 1 to the center. Below full
+    `hardness` only the inner `hardness` fraction of that is solid, the ring outside is dithered
+    with a density falling linearly to zero at the border.
+    """
+    side = 2 * radius + 1
+    if shape == "square":
+        mask = np.ones((side, side), dtype=np.int8)
+    else:
+        axes = np.ogrid[(slice(-radius, radius + 1),) * (3 if shape == "sphere" else 2)]
+        distance = np.sqrt(sum(axis.astype(np.float32) ** 2 for axis in axes)) / (radius + 1)
+        if hardness >= 1:
+            mask = np.int8(distance < 1)
+        else:
+            density = np.clip((1 - distance) / (1 - hardness), 0, 1)
+            threshold = np.tile(_BAYER, (side // 4 + 1, side // 4 + 1))[:side, :side]
+            mask = np.int8(density >= threshold)
+    mask.flags.writeable = False
+    return mask
+
+
+def paint(view: np.ndarray, row: int, col: int, brush: np.ndarray, action):
+    """Apply `action` to the part of the 2d `view` under the square `brush` placed at (row, col)."""
+    r = brush.shape[0] // 2
+    rows, cols = view.shape
+    ra, rb, ro = max(0, row - r - 1), min(row + r, rows), abs(min(0, row - r - 1))
+    ca, cb, co = max(0, col - r - 1), min(col + r, cols), abs(min(0, col - r - 1))
+    view[ra:rb, ca:cb] = action(brush[ro:ro + rb - ra, co:co + cb - ca], view[ra:rb, ca:cb])
+
+
+def bounds(shape: tuple, plane: str, index: int, row: int, col: int, brush: tuple) -> tuple:
+    """Box of the (x, y, z) volume of `shape` that `stroke` can change."""
+    mask = kernel(*brush)
+    r = mask.shape[-1] // 2
+    depth = r if mask.ndim == 3 else 0
+    rows, cols = render.plane_shape(shape, plane)
+    axis = render.PLANE_AXES[plane]
+    box = [slice(max(0, row - r - 1), min(row + r, rows)), slice(max(0, col - r - 1), min(col + r, cols))]
+    box.insert(axis, slice(max(0, index - depth), min(index + depth + 1, shape[axis])))
+    return tuple(box)
+
+
+def stroke(segm: np.ndarray, plane: str, index: int, row: int, col: int, brush: tuple, action):
+    """Paint `brush` (shape, radius, hardness) on `segm` at (row, col) of the plane `index`.
+
+    A sphere paints each of its layers on the neighbouring planes.
+    """
+    mask = kernel(*brush)
+    if mask.ndim == 2:
+        paint(render.plane(segm, plane, index), row, col, mask, action)
+        return
+    r = mask.shape[0] // 2
+    depth = segm.shape[render.PLANE_AXES[plane] - 3]
+    for layer in range(max(0, r - index), min(2 * r + 1, depth - index + r)):
+        paint(render.plane(segm, plane, index + layer - r), row, col, mask[layer], action)
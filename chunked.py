@@ -0,0 +1,171 @@
+"""Native case format: every volume cut along z into chunks that are zlib-compressed independently.
+
+    case_path/chunks/meta.json       shapes, dtypes, chunk depth and the registration data
+    case_path/chunks/scan.0000.z     planes 0:depth of the (phases, x, y, z) scan, cut to bottom:top
+    case_path/chunks/segm.0000.z     planes 0:depth of the (x, y, z) segmentation
+
+Reading a plane inflates one chunk instead of the whole gzip stream, and an edit rewrites only the
+chunks it touches, which are also the only files to sync. Convert registered cases with
+
+    python -m frontend_liver.chunked CASE_PATH [CASE_PATH ...]
+"""
+import argparse
+import json
+import shutil
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+FOLDER = "chunks"
+PHASES = ["b", "a", "v", "t"]
+
+
+def chunks_path(case_path: Path) -> Path:
+    return case_path / FOLDER
+
+
+def exists(case_path: Path) -> bool:
+    return (chunks_path(case_path) / "meta.json").exists()
+
+
+def read_meta(case_path: Path) -> dict:
+    with open(chunks_path(case_path) / "meta.json") as f:
+        return json.load(f)
+
+
+def write_chunk(path: Path, values: np.ndarray, level: int):
+    partial = path.with_name(path.name + ".part")
+    partial.write_bytes(zlib.compress(np.ascontiguousarray(values).tobytes(), level))
+    partial.replace(path)
+
+
+class ChunkedVolume:
+    """One volume of a chunked case, read and written by z-planes. Keeps the last `cache` chunks inflated."""
+
+    def __init__(self, case_path: Path, name: str, cache: int = 8):
+        meta = read_meta(case_path)
+        self.path = chunks_path(case_path)
+        self.name = name
+        self.shape = tuple(meta["volumes"][name]["shape"])
+        self.dtype = np.dtype(meta["volumes"][name]["dtype"])
+        self.depth = meta["depth"]
+        self.level = meta["level"]
+        self.cache = cache
+        self._chunks = OrderedDict()
+
+    def chunk_path(self, index: int) -> Path:
+        return self.path / f"{self.name}.{index:04d}.z"
+
+    def chunk(self, index: int) -> np.ndarray:
+        """Planes index * depth: (index + 1) * depth, read only."""
+        if index in self._chunks:
+            self._chunks.move_to_end(index)
+            return self._chunks[index]
+        depth = min(self.depth, self.shape[-1] - index * self.depth)
+        data = zlib.decompress(self.chunk_path(index).read_bytes())
+        chunk = np.frombuffer(data, dtype=self.dtype).reshape(*self.shape[:-1], depth)
+        self._chunks[index] = chunk
+        while len(self._chunks) > self.cache:
+            self._chunks.popitem(last=False)
+        return chunk
+
+    def _spans(self, start: int, stop: int):
+        """For each chunk meeting planes start:stop: its index, its planes and the matching planes of the range."""
+        for index in range(start // self.depth, (stop - 1) // self.depth + 1):
+            lo, hi = max(start, index * self.depth), min(stop, (index + 1) * self.depth)
+            yield index, slice(lo - index * self.depth, hi - index * self.depth), slice(lo - start, hi - start)
+
+    def plane(self, z: int) -> np.ndarray:
+        return self.chunk(z // self.depth)[..., z % self.depth]
+
+    def read(self, start: int = 0, stop: int = None, pool: ThreadPoolExecutor = None) -> np.ndarray:
+        """Planes start:stop. With a `pool` the chunks are inflated in parallel (zlib releases the GIL)."""
+        stop = self.shape[-1] if stop is None else stop
+        out = np.empty((*self.shape[:-1], stop - start), dtype=self.dtype)
+
+        def copy(span):
+            index, inner, outer = span
+            out[..., outer] = self.chunk(index)[..., inner]
+
+        if pool is None:
+            for span in self._spans(start, stop):
+                copy(span)
+        else:
+            list(pool.map(copy, list(self._spans(start, stop))))
+        return out
+
+    def write(self, start: int, values: np.ndarray) -> list:
+        """Write planes start:start + n, recompressing only the chunks they touch. Returns the files written."""
+        written = []
+        for index, inner, outer in self._spans(start, start + values.shape[-1]):
+            chunk = np.array(self.chunk(index))
+            chunk[..., inner] = values[..., outer]
+            write_chunk(self.chunk_path(index), chunk, self.level)
+            self._chunks.pop(index, None)
+            written.append(self.chunk_path(index))
+        return written
+
+
+def convert(case_path: Path, depth: int = 8, level: int = 1) -> Path:
+    """Write the chunked copy of a registered case: its phases, its segmentation (if any) and its registration data."""
+    from . import nibabel_utils as nu
+    data = nu.load(case_path, scan=True, segm=True, dtype=np.int16)
+    affine, bottom, top, height = nu.load_registration_data(case_path)
+    volumes = dict(scan=data["scan"])
+    if data["segm"] is not None:
+        volumes["segm"] = data["segm"].astype(np.uint8)
+
+    target = chunks_path(case_path)
+    partial = target.with_name(target.name + ".part")
+    shutil.rmtree(partial, ignore_errors=True)
+    partial.mkdir()
+    with ThreadPoolExecutor() as pool:
+        list(pool.map(
+            lambda job: write_chunk(partial / f"{job[0]}.{job[1]:04d}.z", job[2], level),
+            [(name, index, volume[..., start:start + depth])
+             for name, volume in volumes.items()
+             for index, start in enumerate(range(0, volume.shape[-1], depth))],
+        ))
+    meta = dict(
+        depth=depth,
+        level=level,
+        phases=PHASES,
+        affine=np.asarray(affine).tolist(),
+        bottom=int(bottom),
+        top=int(top),
+        height=int(height),
+        volumes={name: dict(shape=list(volume.shape), dtype=volume.dtype.str) for name, volume in volumes.items()},
+    )
+    with open(partial / "meta.json", "w") as f:
+        json.dump(meta, f)
+    shutil.rmtree(target, ignore_errors=True)
+    partial.replace(target)
+    return target
+
+
+def load(case_path: Path, scan: bool = True, segm: bool = False) -> dict:
+    """Whole volumes of a chunked case, like nibabel_utils.load; a volume that is not there is None."""
+    volumes = read_meta(case_path)["volumes"]
+    with ThreadPoolExecutor() as pool:
+        return dict(
+            scan=ChunkedVolume(case_path, "scan").read(pool=pool) if scan else None,
+            segm=ChunkedVolume(case_path, "segm").read(pool=pool) if segm and "segm" in volumes else None,
+            name=str(case_path.name),
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("case_paths", type=Path, nargs="+")
+    parser.add_argument("--depth", type=int, default=8, help="Planes per chunk.")
+    parser.add_argument("--level", type=int, default=1, help="zlib compression level.")
+    args = parser.parse_args()
+    for case_path in args.case_paths:
+        print("Converted", convert(case_path, args.depth, args.level))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import queue
 import tempfile
 import time
 from enum import Enum
@@ -11,8 +12,12 @@ import tkinter as tk
 from .shared_ndarray import SharedNdarray
 from . import nibabel_utils as nu
 from . import pydrive_utils as pu
+from .io_loop import IOLoop
 from .mainwindow import MainWindow
 from .main import args
+from .prefetch import Prefetcher
+
+SOURCES_ROOT = "1N5UQx2dqvWy1d6ve1TEgEFthE8tEApxq"
 
 
 class states(Enum):
@@ -43,12 +48,25 @@ class GDriveScreen(tk.Toplevel):
         self.select_label = tk.Label(self, text="Select the case to load.")
         self.case_choices_var = tk.StringVar(value=[])
         self.cases_listbox = tk.Listbox(self, listvariable=self.case_choices_var)
+        self.cases_listbox.bind("<<ListboxSelect>>", self.prefetch_selection)
         self.select_button = tk.Button(self, text="Load selected case",
                                        command=lambda: self.set_state(states.DOWNLOADING))
 
         self.downloading_label = tk.Label(self, text=f"Downloading...")
+        self.cancel_button = tk.Button(self, text="Cancel", command=self.cancel_download)
+        self.download = None
 
         self.uploading_label = tk.Label(self, text=f"Uploading...")
+
+        self.prefetcher = Prefetcher(
+            self.root.tmpdir_path,
+            source=None if args.debug else pu.DrivePath(["sources"], root=SOURCES_ROOT),
+            depth=args.prefetch,
+            disk_budget=int(args.cache_budget * 2 ** 30),
+            bandwidth=args.bandwidth and args.bandwidth * 2 ** 20,
+        )
+        self.io = IOLoop()
+        self.io.poll(self.root)
         self.set_state(states.CONNECTING)
         self.protocol("WM_DELETE_WINDOW", self.on_window_deleted)
 
@@ -58,19 +76,16 @@ class GDriveScreen(tk.Toplevel):
 
     def set_state(self, state: states):
         if state == states.CONNECTING:
-            self.root.withdraw()
+            self.root.deiconify()
             self.deiconify()
             self.connecting_label.grid(column=1, row=2)
             self.select_label.grid_forget()
             self.cases_listbox.grid_forget()
             self.select_button.grid_forget()
             self.downloading_label.grid_forget()
+            self.cancel_button.grid_forget()
             self.uploading_label.grid_forget()
-            self.root.update()
-
-            files = self.connect_to_gdrive()
-            self.case_choices_var.set(files)
-            self.set_state(states.SELECTING)
+            self.connect_in_background()
         elif state == states.SELECTING:
             self.root.withdraw()
             self.deiconify()
@@ -79,6 +94,7 @@ class GDriveScreen(tk.Toplevel):
             self.cases_listbox.grid(column=1, row=2)
             self.select_button.grid(column=1, row=3)
             self.downloading_label.grid_forget()
+            self.cancel_button.grid_forget()
             self.uploading_label.grid_forget()
             self.root.update()
         elif state == states.DOWNLOADING:
@@ -89,10 +105,9 @@ class GDriveScreen(tk.Toplevel):
             self.cases_listbox.grid_forget()
             self.select_button.grid_forget()
             self.downloading_label.grid(column=1, row=2)
+            self.cancel_button.grid(column=1, row=3)
             self.uploading_label.grid_forget()
-
             self.load_selected()
-            self.set_state(states.DISABLED)
         elif state == states.UPLOADING:
             self.root.withdraw()
             self.deiconify()
@@ -101,10 +116,10 @@ class GDriveScreen(tk.Toplevel):
             self.cases_listbox.grid_forget()
             self.select_button.grid_forget()
             self.downloading_label.grid_forget()
+            self.cancel_button.grid_forget()
             self.uploading_label.grid(column=1, row=2)
             self.update()
             self.overwrite()
-            self.set_state(states.DISABLED)
         else:
             if self.root.selected_case is None:
                 self.set_state(states.SELECTING)
@@ -114,50 +129,98 @@ class GDriveScreen(tk.Toplevel):
             self.cases_listbox.grid_forget()
             self.select_button.grid_forget()
             self.downloading_label.grid_forget()
+            self.cancel_button.grid_forget()
             self.uploading_label.grid_forget()
             self.withdraw()
             self.root.trigger_draw()
             self.root.deiconify()
 
+    def prefetch_selection(self, *args):
+        selection = self.cases_listbox.curselection()
+        if not selection:
+            return
+        first = selection[0]
+        self.prefetcher.schedule(
+            self.cases_listbox.get(first, first + self.prefetcher.depth),
+            keep=list(self.root.session.cases),
+        )
+
     def load_selected(self):
         case = self.cases_listbox.get(tk.ACTIVE)
-        self.root.vars.selected_case.set(str(case))
-        if args.debug:
-            self.root.tmpdir_path = self.root.tmpdir_path / case
-            for i in range(5):
-                self.downloading_label.config(text=f"Downloading nothing ({i + 1}/{5})...")
-                self.downloading_label.update()
-                time.sleep(0.1)
+        if case in self.root.session:
+            self.root.switch_case(case)
+            self.prefetch_selection()
+            self.set_state(states.DISABLED)
+            return
+        if not self.prefetcher.is_ready(case):
+            self.downloading_label.config(text=f"Waiting for {case}...")
+        self.download = self.io.submit(self.fetch_case(case), done=partial(self.case_fetched, case))
+
+    async def fetch_case(self, case):
+        """Download and read `case` off the Tk thread, reporting progress on the label."""
+        status = self.io.progress(lambda text: self.downloading_label.config(text=text))
+        await self.io.blocking(
+            self.prefetcher.fetch, case, limit="drive", decode=False,
+            progress=lambda i, n: status(f"Downloading {case} ({i + 1}/{n})..."),
+        )
+        status("Converting to numpy...")
+        case_path = self.prefetcher.case_path(case)
+        return await self.io.blocking(nu.load, case_path, limit="disk", scan=True, segm=True, dtype=np.int16)
+
+    def case_fetched(self, case, future):
+        self.download = None
+        if future.cancelled():
+            print(f"Loading of {case} cancelled.")
+        elif future.exception() is not None:
+            print(f"Loading of {case} failed.", future.exception())
         else:
-            case = pu.DrivePath(["sources"], root="1N5UQx2dqvWy1d6ve1TEgEFthE8tEApxq") / case
-            files = list(case.iterdir())
-            for i, file in enumerate(files):
-                self.downloading_label.config(text=f"Downloading {case.name} ({i + 1}/{len(files)})...")
-                self.downloading_label.update()
-                file.resolve().obj.GetContentFile(self.root.tmpdir_path / file.name)
-        self.downloading_label.config(text="Converting to numpy...")
-        self.downloading_label.update()
-        data = nu.load(self.root.tmpdir_path, scan=True, segm=True, clip=(0, 255))
-        self.root.selected_case = str(case)
-        self.root.vars.scan_height.set(data["scan"].shape[-1])
-        self.root.vars.z.set(0)
-        self.root.start_base_image_process(data["scan"])
-        self.root.case_shape = data["scan"].shape[1:]
-        self.root.start_over_image_process(data["segm"])
+            data = future.result()
+            self.root.open_case(
+                str(case), self.prefetcher.case_path(case), data["scan"], data["segm"], data["dirty"])
+            self.prefetch_selection()
+        self.set_state(states.DISABLED)
+
+    def cancel_download(self):
+        if self.download is not None:
+            self.download.cancel()
 
     def overwrite(self):
-        target_case = pu.DrivePath(["sources"], root="1N5UQx2dqvWy1d6ve1TEgEFthE8tEApxq")\
-                      / self.root.vars.selected_case.get()
+        self.uploading_label.config(text="Saving...")
         self.root.over_image_editque.put(
             SimpleNamespace(
-                save=True,
+                handle=self.root.handle,
+                save=self.root.case_path,
+                delta=True,
             )
         )
-        segm = self.root.over_image_saveque.get(block=True)
-        nu.save_segmentation(segm, self.root.tmpdir_path)
+        self.after(50, self.upload_saved)
+
+    def upload_saved(self):
+        """Wait for the overlay worker to write the segmentation without blocking Tk, then upload it."""
+        try:
+            saved = self.root.over_image_saveque.get_nowait()
+        except queue.Empty:
+            self.after(50, self.upload_saved)
+            return
+        if saved.path is None:
+            self.set_state(states.DISABLED)
+            return
+        self.uploading_label.config(text="Uploading...")
+        case = self.root.vars.selected_case.get()
+        self.io.submit(self.io.blocking(self.upload, saved, case, limit="drive"), done=self.uploaded)
 
-        source_file = self.root.tmpdir_path / "segmentation.nii.gz"
-        target_file = target_case / "segmentation.nii.gz"
+    def upload(self, saved, case):
+        target_case = pu.DrivePath(["sources"], root=SOURCES_ROOT) / case
+        source_file, md5 = saved.path, saved.md5
+        if source_file == nu.patch_path(source_file.parent):
+            # Someone may have uploaded a whole segmentation since this one was downloaded: the patch
+            # would not apply to it, and the edits would be lost. Send a whole segmentation then.
+            remote = target_case / "segmentation.nii.gz"
+            remote_md5 = remote.obj.get("md5Checksum") if remote.exists() else None
+            if remote_md5 != nu.patch_base(source_file.parent):
+                print("  The segmentation on Drive is not the base of the patch: uploading it whole.")
+                source_file, md5 = nu.merge_patch(source_file.parent)
+        target_file = target_case / source_file.name
 
         if not target_file.exists():
             f = pu.drive.CreateFile(dict(title=source_file.name, parents=[{"id": target_case.id}]))
@@ -169,13 +232,41 @@ class GDriveScreen(tk.Toplevel):
             print("  Overwriting", source_file.name)
         f.SetContentFile(str(source_file))
         f.Upload()
+        if f.get("md5Checksum", md5) != md5:
+            print("  Checksum mismatch after upload!", f.get("md5Checksum"), md5)
+        patch = nu.patch_path(source_file.parent)
+        target_patch = target_case / patch.name
+        if source_file != patch and target_patch.exists():
+            # The whole segmentation went up: the patch of the previous one no longer applies.
+            pu.drive.CreateFile(dict(id=target_patch.id)).Delete()
         print(f"  ...done!")
-    
+
+    def uploaded(self, future):
+        if future.exception() is not None:
+            print("Upload failed.", future.exception())
+        self.set_state(states.DISABLED)
+
+    def connect_in_background(self):
+        """Authenticate and list the cases on the I/O loop, so that the windows show and stay responsive meanwhile."""
+        def connect():
+            pu.connect(mock=args.debug)
+            return self.connect_to_gdrive()
+
+        self.io.submit(self.io.blocking(connect, limit="drive"), done=self.connected)
+
+    def connected(self, future):
+        if future.exception() is not None:
+            print("Connection failed.", future.exception())
+            self.connecting_label.config(text=f"Connection to Google Drive failed: {future.exception()}")
+        else:
+            self.case_choices_var.set(future.result())
+            self.set_state(states.SELECTING)
+
     def connect_to_gdrive(self):
         if args.debug:
             time.sleep(0.5)
             return [p.relative_to(self.root.tmpdir_path) for p in self.root.tmpdir_path.iterdir()]
-        sources = pu.DrivePath(["sources"], root="1N5UQx2dqvWy1d6ve1TEgEFthE8tEApxq")
+        sources = pu.DrivePath(["sources"], root=SOURCES_ROOT)
         files = sorted([path.relative_to(sources) for path in sources.iterdir()])
         # files = [path.relative_to(sources) for path in pu.iter_registered(sources)]
         # root.store.available_cases = files
@@ -214,24 +305,3 @@ class GDriveScreen(tk.Toplevel):
 # def close_both(root, cst):
 #     cst.destroy()
 #     root.destroy()
-
-
-    
-
-
-# def avgpool(array, pool_factor):
-#     C, X, Y, Z = array.shape
-#     return array.reshape(C, X // pool_factor, pool_factor, Y // pool_factor, pool_factor, Z).mean(axis=(2, 4))
-#
-#
-# def maxpool(array, pool_factor):
-#     X, Y, Z = array.shape
-#     return array.reshape(X // pool_factor, pool_factor, Y // pool_factor, pool_factor, Z).max(axis=(1, 3))
-
-
-def unmaxpool(array, pool_factor):
-    X, Y, Z = array.shape
-    array = np.repeat(array, pool_factor, axis=2)
-    array = np.repeat(array, pool_factor, axis=1)
-    array = np.repeat(array, pool_factor, axis=0)
-    return array
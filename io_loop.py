@@ -0,0 +1,85 @@
+import asyncio
+import functools
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+# Default number of calls of each kind that may run at once.
+LIMITS = {"drive": 4, "disk": 2}
+
+
+class IOLoop:
+    """An asyncio loop on its own thread for the Drive and disk I/O of the GUI.
+
+    Blocking calls (pydrive, nibabel) are awaited through `blocking`, which runs them on a thread pool
+    while holding a slot of a named concurrency limit. Tk is not thread safe: whatever must reach the
+    GUI is queued with `to_tk` and called by `poll`, which reschedules itself on a widget with `after`.
+    """
+
+    def __init__(self, threads: int = 8, limits: dict = None):
+        self.limits = dict(LIMITS, **(limits or {}))
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="io")
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(self.executor)
+        self._semaphores = {}
+        self._calls = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def semaphore(self, limit: str) -> asyncio.Semaphore:
+        # Created on first use, from the loop thread, so that it belongs to the loop.
+        if limit not in self._semaphores:
+            self._semaphores[limit] = asyncio.Semaphore(self.limits[limit])
+        return self._semaphores[limit]
+
+    async def blocking(self, fn: Callable, *args, limit: Optional[str] = None, **kwargs):
+        """Await `fn(*args, **kwargs)` run on the thread pool, within the `limit` concurrency limit.
+
+        Cancelling the awaiting task drops a call that has not started yet. A started call runs to
+        its end on its thread, and its result is discarded.
+        """
+        call = functools.partial(fn, *args, **kwargs)
+        if limit is None:
+            return await self.loop.run_in_executor(None, call)
+        async with self.semaphore(limit):
+            return await self.loop.run_in_executor(None, call)
+
+    def submit(self, coroutine, done: Callable[[Future], None] = None) -> Future:
+        """Run `coroutine` on the loop; `future.cancel()` cancels it. `done(future)` is called on the Tk thread."""
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        if done is not None:
+            future.add_done_callback(functools.partial(self.to_tk, done))
+        return future
+
+    def to_tk(self, fn: Callable, *args):
+        """Have `fn(*args)` called on the Tk thread by the next `poll`; callable from any thread."""
+        self._calls.put((fn, args))
+
+    def progress(self, fn: Callable) -> Callable:
+        """`fn` as a callback that can be called from any thread, and runs on the Tk thread."""
+        return functools.partial(self.to_tk, fn)
+
+    def poll(self, widget, interval: int = 50):
+        """Run the queued Tk calls, then again every `interval` ms on `widget` while the loop lives."""
+        while True:
+            try:
+                fn, args = self._calls.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                fn(*args)
+            except Exception as err:
+                print(f"I/O callback {getattr(fn, '__name__', fn)} failed.", err)
+        if self._thread.is_alive():
+            widget.after(interval, self.poll, widget, interval)
+
+    def stop(self):
+        def shutdown():
+            for task in asyncio.all_tasks(self.loop):
+                task.cancel()
+            self.loop.stop()
+
+        self.loop.call_soon_threadsafe(shutdown)
+        self._thread.join(timeout=2)
+        self.executor.shutdown(wait=False, cancel_futures=True)
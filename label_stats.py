@@ -0,0 +1,45 @@
+from typing import Optional
+
+import numpy as np
+
+LABELS = (1, 2)
+
+
+def histogram(block: np.ndarray) -> list:
+    """For each (x, y, z) axis, the voxels of each label in every plane along it, as (labels, size)."""
+    occupancy = [np.zeros((len(LABELS), size), dtype=np.int64) for size in block.shape]
+    for i, label in enumerate(LABELS):
+        mask = block == label
+        occupancy[2][i] = mask.sum(axis=(0, 1))
+        xy = mask.sum(axis=2)
+        occupancy[0][i] = xy.sum(axis=1)
+        occupancy[1][i] = xy.sum(axis=0)
+    return occupancy
+
+
+class LabelStats:
+    """Per plane label counts of a segmentation, kept up to date from the boxes that edits touch."""
+
+    def __init__(self, segm):
+        self.occupancy = segm.histogram() if hasattr(segm, "histogram") else histogram(segm)
+
+    @property
+    def counts(self) -> np.ndarray:
+        return self.occupancy[2].sum(axis=1)
+
+    def update(self, box: tuple, before: list, after: list):
+        """Account for an edit of `segm[box]`, given the histograms of the box before and after it."""
+        for axis, (old, new) in enumerate(zip(before, after)):
+            self.occupancy[axis][:, box[axis]] += new - old
+
+
+def next_labelled(occupancy: np.ndarray, index: int, step: int) -> Optional[int]:
+    """The first plane after `index` (before it if `step` is negative) that holds any label."""
+    labelled = np.flatnonzero(occupancy.any(axis=0))
+    labelled = labelled[labelled > index] if step > 0 else labelled[labelled < index][::-1]
+    return int(labelled[0]) if len(labelled) else None
+
+
+def voxel_volume(affine: np.ndarray) -> float:
+    """Volume of a voxel in cm³, from the affine in mm."""
+    return abs(np.linalg.det(affine[:3, :3])) / 1000
@@ -0,0 +1,80 @@
+import itertools
+
+import numpy as np
+
+from . import label_stats, render
+
+
+class BlockLabels:
+    """Label volume kept as cubic blocks of side `side`, storing only the blocks that hold a label.
+
+    Memory and pickling scale with the labelled part of the volume. Edits read a dense copy of the
+    box they touch and write it back; `dense()` rebuilds the whole volume when an operation needs it.
+    """
+
+    def __init__(self, shape: tuple, side: int = 32):
+        self.shape = tuple(shape)
+        self.side = side
+        self.blocks = {}
+
+    @classmethod
+    def from_dense(cls, dense: np.ndarray, side: int = 32) -> "BlockLabels":
+        store = cls(dense.shape, side)
+        store.write((slice(None),) * 3, dense)
+        return store
+
+    @property
+    def nbytes(self) -> int:
+        return sum(block.nbytes for block in self.blocks.values())
+
+    def _parts(self, box: tuple):
+        """For each block meeting `box`: its key, its slices and the matching slices of the box."""
+        ranges = [s.indices(size)[:2] for s, size in zip(box, self.shape)]
+        keys = [range(start // self.side, (stop - 1) // self.side + 1) for start, stop in ranges]
+        for key in itertools.product(*keys):
+            inner, outer = [], []
+            for k, (start, stop) in zip(key, ranges):
+                lo, hi = max(start, k * self.side), min(stop, (k + 1) * self.side)
+                inner.append(slice(lo - k * self.side, hi - k * self.side))
+                outer.append(slice(lo - start, hi - start))
+            yield key, tuple(inner), tuple(outer)
+
+    def read(self, box: tuple) -> np.ndarray:
+        shape = [len(range(*s.indices(size))) for s, size in zip(box, self.shape)]
+        dense = np.zeros(shape, dtype=np.uint8)
+        for key, inner, outer in self._parts(box):
+            if key in self.blocks:
+                dense[outer] = self.blocks[key][inner]
+        return dense
+
+    def write(self, box: tuple, values: np.ndarray):
+        for key, inner, outer in self._parts(box):
+            block = self.blocks.get(key)
+            if block is None:
+                if not values[outer].any():
+                    continue
+                block = np.zeros(
+                    [min(self.side, size - k * self.side) for k, size in zip(key, self.shape)], dtype=np.uint8)
+            block[inner] = values[outer]
+            if block.any():
+                self.blocks[key] = block
+            else:
+                self.blocks.pop(key, None)
+
+    def dense(self) -> np.ndarray:
+        return self.read((slice(None),) * 3)
+
+    def plane(self, plane: str, index: int) -> np.ndarray:
+        box = [slice(None)] * 3
+        axis = render.PLANE_AXES[plane]
+        box[axis] = slice(index, index + 1)
+        return np.take(self.read(tuple(box)), 0, axis=axis)
+
+    def histogram(self) -> list:
+        """label_stats.histogram of the whole volume, summed over the stored blocks only."""
+        occupancy = [np.zeros((len(label_stats.LABELS), size), dtype=np.int64) for size in self.shape]
+        for key, block in self.blocks.items():
+            for axis, counts in enumerate(label_stats.histogram(block)):
+                start = key[axis] * self.side
+                occupancy[axis][:, start:start + counts.shape[1]] += counts
+        return occupancy
@@ -3,6 +3,11 @@ import argparse
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--debug", action="store_true", default=False)
+parser.add_argument("--prefetch", type=int, default=2, help="How many of the next cases to prefetch.")
+parser.add_argument("--cache-budget", type=float, default=8, help="Disk budget of the case cache, in GB.")
+parser.add_argument("--bandwidth", type=float, default=None, help="Prefetch bandwidth budget, in MB/s.")
+parser.add_argument("--memory-budget", type=float, default=4, help="Memory for the open cases, in GB.")
+parser.add_argument("--trace", type=str, default=None, help="Write the frame timings to this file on exit.")
 args = parser.parse_args()
 
 def main(main_class):
@@ -22,5 +27,4 @@ if __name__ == "__main__":
     sys.path.append(str(this_folder.parent))
 
     this_module = importlib.import_module(this_folder.name)
-    this_module.connect(path=this_folder, mock=args.debug)
     main(this_module.MainWindow)
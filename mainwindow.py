@@ -1,6 +1,6 @@
-import multiprocessing
 import queue
 import tempfile
+import time
 import tkinter as tk
 from dataclasses import dataclass
 from functools import partial
@@ -17,19 +17,36 @@ from . import over_draw_process
 from . import base_draw_process
 
 from . import nibabel_utils as nu
+from . import label_stats, processes, render, timing
+from .session import Session
 from .shared_ndarray import SharedNdarray
 
+# Milliseconds between scroll steps under which frames come from the coarse levels, until scrolling stops.
+REFINE_DELAY = 150
+
 
 @dataclass
 class Store:
+    base_resample: tk.StringVar
     brush_action: tk.IntVar
+    brush_hardness: tk.DoubleVar
     brush_radius: tk.IntVar
+    brush_shape: tk.StringVar
+    brush_tool: tk.StringVar
     flip_x: tk.BooleanVar
+    fill_tolerance: tk.IntVar
+    label_volumes: tk.StringVar
     flip_y: tk.BooleanVar
+    layout: tk.StringVar
+    over_resample: tk.StringVar
     phase: tk.IntVar
+    plane: tk.StringVar
+    resolution: tk.IntVar
     scan_height: tk.IntVar
+    show_hud: tk.BooleanVar
     selected_case: tk.StringVar
     swap_xy: tk.BooleanVar
+    tiled: tk.BooleanVar
     z: tk.IntVar
 
 
@@ -44,26 +61,45 @@ class MainWindow(tk.Tk):
         self.loaded_segm = None
         self.edit_process = None
         self.action = None
-        self.brush = None
         self.selected_case = None
         self.case_shape = None
-
-        self.base_image_reqque = multiprocessing.Queue(100)
-        self.base_image_retque = multiprocessing.Queue(100)
-        self.base_image_process = base_draw_process.Worker(self.base_image_reqque, self.base_image_retque, None)
+        self.case_path = None
+        self.handle = None
+        self.zoom = 1.0
+        self.center = None
+        self.pan_start = None
+        self.shown_plane = "axial"
+        self.positions = {}
+        self.windows = {phase: render.WINDOW_PRESETS["Default"] for phase in range(4)}
+        self.window_start = None
+        self.session = Session(int(args.memory_budget * 2 ** 30), self.evict_case)
+
+        self.timings = timing.Ring()
+        self.hud_id = None
+        self.hud_time = 0.0
+        self.scrolling = False
+        self.scroll_time = 0.0
+        self.refine_id = None
+
+        self.base_image_reqque = processes.context().Queue(100)
+        self.base_image_retque = processes.context().Queue(100)
+        self.base_image_process = base_draw_process.Worker(
+            self.base_image_reqque, self.base_image_retque, self.timings)
         self.base_image_id = None
         self.base_imgtk = None
 
-        self.over_image_editque = multiprocessing.Queue(100)
-        self.over_image_drawque = multiprocessing.Queue(100)
-        self.over_image_retque = multiprocessing.Queue(100)
-        self.over_image_saveque = multiprocessing.Queue(100)
+        self.over_image_editque = processes.context().Queue(100)
+        self.over_image_drawque = processes.context().Queue(100)
+        self.over_image_retque = processes.context().Queue(100)
+        self.over_image_saveque = processes.context().Queue(100)
+        self.over_image_statsque = processes.context().Queue(100)
         self.over_image_process = over_draw_process.Worker(
             self.over_image_drawque,
             self.over_image_editque,
             self.over_image_retque,
             self.over_image_saveque,
-            None,
+            self.over_image_statsque,
+            self.timings,
         )
         self.over_imgtk = None
         self.over_image_id = None
@@ -75,14 +111,26 @@ class MainWindow(tk.Tk):
             self.tmpdir_path = Path(self.tmpdir.name)
 
         self.vars = Store(
+            base_resample=tk.StringVar(value="bicubic"),
             brush_action=tk.IntVar(value=1),
+            brush_hardness=tk.DoubleVar(value=1.0),
             brush_radius=tk.IntVar(value=5),
+            brush_shape=tk.StringVar(value="circle"),
+            brush_tool=tk.StringVar(value="brush"),
             flip_x=tk.BooleanVar(value=True),
+            fill_tolerance=tk.IntVar(value=40),
+            label_volumes=tk.StringVar(value=""),
             flip_y=tk.BooleanVar(value=False),
+            layout=tk.StringVar(value="single"),
+            over_resample=tk.StringVar(value="bicubic"),
             phase=tk.IntVar(value=2),
+            plane=tk.StringVar(value="axial"),
+            resolution=tk.IntVar(value=800),
             scan_height=tk.IntVar(value=1),
+            show_hud=tk.BooleanVar(value=False),
             selected_case=tk.StringVar(value=""),
             swap_xy=tk.BooleanVar(value=True),
+            tiled=tk.BooleanVar(value=True),
             z=tk.IntVar(value=0),
         )
         self.vars.flip_x.trace_add("write", self.trigger_draw)
@@ -90,28 +138,53 @@ class MainWindow(tk.Tk):
         self.vars.swap_xy.trace_add("write", self.trigger_draw)
         self.vars.phase.trace_add("write", self.trigger_draw)
         self.vars.z.trace_add("write", self.trigger_draw)
+        self.vars.base_resample.trace_add("write", self.trigger_draw)
+        self.vars.over_resample.trace_add("write", self.trigger_draw)
+        self.vars.tiled.trace_add("write", self.trigger_draw)
+        self.vars.resolution.trace_add("write", self.set_resolution)
+        self.vars.plane.trace_add("write", self.set_plane)
+        self.vars.layout.trace_add("write", self.trigger_draw)
         self.vars.brush_action.trace_add("write", self.set_action)
+        self.vars.brush_hardness.trace_add("write", self.set_brush)
         self.vars.brush_radius.trace_add("write", self.set_brush)
+        self.vars.brush_shape.trace_add("write", self.set_brush)
 
         self.gdrive_screen = GDriveScreen(self)
         self.menubar = Menubar(self)
-        self.resolution = 800
         self.canvas = tk.Canvas(
-            self, bg="black", height=self.resolution, width=self.resolution)
+            self, bg="black", height=self.vars.resolution.get(), width=self.vars.resolution.get())
 
         self.canvas.bind("<MouseWheel>", mouse_wheel(self))
         self.canvas.bind("<Button-4>", mouse_wheel(self))
         self.canvas.bind("<Button-5>", mouse_wheel(self))
         self.canvas.bind("<Button-1>", self.click)
         self.canvas.bind("<B1-Motion>", self.click)
+        self.canvas.bind("<Control-MouseWheel>", zoom_wheel(self))
+        self.canvas.bind("<Control-Button-4>", zoom_wheel(self))
+        self.canvas.bind("<Control-Button-5>", zoom_wheel(self))
+        self.canvas.bind("<Button-2>", self.pan)
+        self.canvas.bind("<B2-Motion>", self.pan)
+        self.canvas.bind("<ButtonRelease-2>", self.pan)
+        self.bind("<Key-0>", self.reset_zoom)
+        self.canvas.bind("<Button-3>", self.drag_window)
+        self.canvas.bind("<B3-Motion>", self.drag_window)
+        self.canvas.bind("<ButtonRelease-3>", self.drag_window)
 
         self.bind("<Up>", lambda e: self.move(1))
         self.bind("<Down>", lambda e: self.move(-1))
 
         self.bind("<Shift-Up>", partial(self.translate, delta=1))
         self.bind("<Shift-Down>", partial(self.translate, delta=-1))
+        self.bind("<Control-Up>", partial(self.propagate, steps=10))
+        self.bind("<Control-Down>", partial(self.propagate, steps=-10))
+
+        self.bind("<F3>", lambda e: self.vars.show_hud.set(not self.vars.show_hud.get()))
+        self.vars.show_hud.trace_add("write", self.show_hud)
+        self.bind("<Next>", lambda e: self.jump_labelled(1))
+        self.bind("<Prior>", lambda e: self.jump_labelled(-1))
 
         self.canvas.pack()
+        tk.Label(self, textvariable=self.vars.label_volumes, anchor=tk.W).pack(fill=tk.X)
 
         self.trigger_draw()
         self.set_action()
@@ -128,28 +201,57 @@ class MainWindow(tk.Tk):
         self.over_image_process = None
 
     def move(self, delta):
+        now = time.perf_counter()
+        self.scrolling = now - self.scroll_time < REFINE_DELAY / 1000
+        self.scroll_time = now
+        if self.refine_id is not None:
+            self.after_cancel(self.refine_id)
+        self.refine_id = self.after(REFINE_DELAY, self.refine) if self.scrolling else None
         try:
             self.vars.z.set(
                 max(0, min(self.vars.z.get() + delta, self.vars.scan_height.get() - 1)))
         except tk.TclError:
             self.vars.z.set(0)
 
+    def refine(self):
+        """Scrolling stopped: draw the last plane again at full resolution."""
+        self.refine_id = None
+        self.scrolling = False
+        self.trigger_draw()
+
     def on_window_deleted(self):
+        from .main import args
+        if args.trace:
+            self.timings.dump(Path(args.trace))
         self.stop()
+        self.gdrive_screen.prefetcher.stop()
+        self.gdrive_screen.io.stop()
         self.destroy()
 
     def process_queues(self):
+        while True:
+            try:
+                stats = self.over_image_statsque.get_nowait()
+            except queue.Empty:
+                break
+            for entry in self.session.cases.values():
+                if entry.handle == stats.handle:
+                    entry.occupancy = stats.occupancy
+            if stats.handle == self.handle:
+                self.show_volumes()
         try:
             img = self.base_image_retque.get_nowait()
             # print("-- got base image --")
-            self.base_imgtk = ImageTk.PhotoImage(img)
-            if self.base_image_id:
-                self.canvas.itemconfig(
-                    self.base_image_id, image=self.base_imgtk)
-            else:
-                self.base_image_id = self.canvas.create_image(
-                    0, 0, anchor=tk.NW, image=self.base_imgtk)
-            self.canvas.update()
+            with self.timings.stage("main.base_frame", timing.depth(self.base_image_retque)):
+                self.base_imgtk = ImageTk.PhotoImage(img)
+                if self.base_image_id:
+                    self.canvas.itemconfig(
+                        self.base_image_id, image=self.base_imgtk)
+                else:
+                    self.base_image_id = self.canvas.create_image(
+                        0, 0, anchor=tk.NW, image=self.base_imgtk)
+                self.canvas.update()
+            self.frame_shown("main.base_latency", img)
             self.after(5, self.process_queues)
             return
         except queue.Empty:
@@ -157,14 +259,16 @@ class MainWindow(tk.Tk):
         try:
             img = self.over_image_retque.get_nowait()
             # print("-- got over image --")
-            self.over_imgtk = ImageTk.PhotoImage(img)
-            if self.over_image_id:
-                self.canvas.itemconfig(
-                    self.over_image_id, image=self.over_imgtk)
-            else:
-                self.over_image_id = self.canvas.create_image(
-                    0, 0, anchor=tk.NW, image=self.over_imgtk)
-            self.canvas.update()
+            with self.timings.stage("main.over_frame", timing.depth(self.over_image_retque)):
+                self.over_imgtk = ImageTk.PhotoImage(img)
+                if self.over_image_id:
+                    self.canvas.itemconfig(
+                        self.over_image_id, image=self.over_imgtk)
+                else:
+                    self.over_image_id = self.canvas.create_image(
+                        0, 0, anchor=tk.NW, image=self.over_imgtk)
+                self.canvas.update()
+            self.frame_shown("main.over_latency", img)
             self.after(5, self.process_queues)
             return
         except queue.Empty:
@@ -172,38 +276,210 @@ class MainWindow(tk.Tk):
         
         self.after(50, self.process_queues)
 
+    def frame_shown(self, stage: str, img):
+        sent = img.info.get("sent")
+        if sent is not None:
+            self.timings.record(stage, sent, time.perf_counter() - sent)
+        if self.vars.show_hud.get() and time.perf_counter() - self.hud_time > 0.25:
+            self.show_hud()
+
+    def show_hud(self, *args):
+        """Frame rate, input to frame latency and queue depths of the last two seconds, over the canvas."""
+        self.hud_time = time.perf_counter()
+        if not self.vars.show_hud.get():
+            if self.hud_id:
+                self.canvas.delete(self.hud_id)
+                self.hud_id = None
+            return
+        summary = self.timings.summary(window=2.0)
+        lines = []
+        for name in ("base", "over"):
+            frames = summary.get(f"main.{name}_frame")
+            latency = summary.get(f"main.{name}_latency")
+            lines.append(
+                f"{name}: {frames['count'] / 2 if frames else 0:.1f} fps"
+                + (f", latency p50 {latency['p50']:.0f} ms p95 {latency['p95']:.0f} ms" if latency else "")
+                + f", queue {summary.get(f'{name}.queue', {}).get('depth', 0)}"
+            )
+        for stage, row in summary.items():
+            if not stage.startswith("main."):
+                lines.append(f"  {stage} {row['p50']:.1f} / {row['p95']:.1f} ms")
+        if self.hud_id is None:
+            self.hud_id = self.canvas.create_text(
+                8, 8, anchor=tk.NW, fill="yellow", font=("TkFixedFont", 9), text="\n".join(lines))
+        else:
+            self.canvas.itemconfig(self.hud_id, text="\n".join(lines))
+        self.canvas.tag_raise(self.hud_id)
+
+    def dump_timings(self, *args):
+        filename = filedialog.asksaveasfilename(
+            title='Save the frame timings',
+            defaultextension=".json",
+            filetypes=(('Chrome trace', '*.json'),),
+        )
+        if filename:
+            self.timings.dump(Path(filename))
+
     def stop(self):
         if self.base_image_process:
             self.base_image_process.stop()
         if self.over_image_process:
             self.over_image_process.stop()
-    
-    def start_base_image_process(self, data: np.ndarray):
-        self.base_image_process.stop()
-        self.base_image_process = base_draw_process.Worker(self.base_image_reqque, self.base_image_retque, data)
+        self.session.clear()
+
+    def open_case(self, case: str, case_path: Path, scan: np.ndarray, segm: np.ndarray, dirty: list = ()):
+        if segm is None:
+            segm = np.zeros(scan.shape[1:])
+        segm = segm.astype(np.uint8)
+        entry = self.session.open(case, case_path, scan, segm)
+        entry.occupancy = None
+        try:
+            entry.voxel_volume = label_stats.voxel_volume(nu.load_registration_data(case_path)[0])
+        except FileNotFoundError:
+            entry.voxel_volume = None
+        self.base_image_reqque.put(SimpleNamespace(open=entry.handle, scan=entry.scan))
+        self.over_image_editque.put(SimpleNamespace(open=entry.handle, segm=segm, scan=entry.scan, dirty=dirty))
+        self.switch_case(case)
+
+    def switch_case(self, case: str):
+        previous = self.session.cases.get(self.selected_case)
+        if previous is not None:
+            previous.positions = dict(self.positions, **{self.shown_plane: self.vars.z.get()})
+        entry = self.session.get(case)
+        self.selected_case = entry.name
+        self.vars.selected_case.set(entry.name)
+        self.handle = entry.handle
+        self.case_path = entry.path
+        self.case_shape = entry.shape
+        self.positions = dict(entry.positions)
+        self.show_plane()
+        self.show_volumes()
+
+    def show_volumes(self):
+        entry = self.session.cases.get(self.selected_case)
+        if entry is None or entry.occupancy is None:
+            self.vars.label_volumes.set("")
+            return
+        liver, tumor = entry.occupancy[2].sum(axis=1)
+        if entry.voxel_volume is None:
+            self.vars.label_volumes.set(f"Liver {liver} voxels, tumor {tumor} voxels")
+        else:
+            self.vars.label_volumes.set(
+                f"Liver {liver * entry.voxel_volume:.1f} cm³, tumor {tumor * entry.voxel_volume:.1f} cm³")
+
+    def jump_labelled(self, step: int):
+        """Show the next slice (previous if `step` is negative) of the shown plane that holds any label."""
+        entry = self.session.cases.get(self.selected_case)
+        if entry is None or entry.occupancy is None:
+            return
+        occupancy = entry.occupancy[render.PLANE_AXES[self.shown_plane]]
+        index = label_stats.next_labelled(occupancy, self.vars.z.get(), step)
+        if index is not None:
+            self.vars.z.set(index)
+
+    def set_plane(self, *args):
+        self.positions[self.shown_plane] = self.vars.z.get()
+        self.show_plane()
+
+    def show_plane(self):
+        self.shown_plane = self.vars.plane.get()
+        if self.case_shape:
+            height = self.case_shape[render.PLANE_AXES[self.shown_plane]]
+            self.vars.scan_height.set(height)
+            self.vars.z.set(self.positions.get(self.shown_plane, 0 if self.shown_plane == "axial" else height // 2))
+        self.reset_zoom()
+
+    def display_size(self):
+        """(width, height) of the slice as displayed, in slice pixels."""
+        shape = render.plane_shape(self.case_shape, self.shown_plane) if self.case_shape else (512, 512)
+        rows, cols = shape[::-1] if self.vars.swap_xy.get() else shape
+        return cols, rows
+
+    def viewport_box(self):
+        """The visible part of the displayed slice, as (left, upper, right, lower) in slice pixels."""
+        width, height = self.display_size()
+        w, h = width / self.zoom, height / self.zoom
+        cx, cy = self.center or (width / 2, height / 2)
+        left = min(max(cx - w / 2, 0), width - w)
+        upper = min(max(cy - h / 2, 0), height - h)
+        return left, upper, left + w, upper + h
+
+    def zoom_at(self, factor: float, x: int, y: int):
+        resolution = self.vars.resolution.get()
+        point = render.canvas_to_cell(x, y, resolution, self.vars.layout.get())
+        if point is None:
+            return
+        x, y = point
+        left, upper, right, lower = self.viewport_box()
+        width, height = self.display_size()
+        px, py = left + x / resolution * (right - left), upper + y / resolution * (lower - upper)
+        self.zoom = min(max(self.zoom * factor, 1.0), 8.0)
+        w, h = width / self.zoom, height / self.zoom
+        # Keep the pixel under the pointer where it is.
+        self.center = (px - x / resolution * w + w / 2, py - y / resolution * h + h / 2)
         self.trigger_draw()
-    
-    def start_over_image_process(self, data: np.ndarray):
-        self.over_image_process.stop()
-        self.over_image_process = over_draw_process.Worker(
-            self.over_image_drawque,
-            self.over_image_editque,
-            self.over_image_retque,
-            self.over_image_saveque,
-            data,
-        )
+
+    def pan(self, event):
+        if event.type == tk.EventType.ButtonRelease:
+            self.pan_start = None
+            return
+        if self.pan_start is not None:
+            left, upper, right, lower = self.viewport_box()
+            resolution = self.vars.resolution.get()
+            if self.vars.layout.get() in render.GRID_LAYOUTS:
+                resolution = resolution / 2
+            x, y = self.pan_start
+            self.center = (
+                (left + right) / 2 - (event.x - x) * (right - left) / resolution,
+                (upper + lower) / 2 - (event.y - y) * (lower - upper) / resolution,
+            )
+            self.trigger_draw()
+        self.pan_start = event.x, event.y
+
+    def set_window(self, level: float, width: float):
+        """Set the intensity window of the shown phase, each phase keeps its own."""
+        self.windows[self.vars.phase.get()] = (level, max(width, 1))
+        self.trigger_draw()
+
+    def drag_window(self, event):
+        # Right drag: horizontal changes the width, vertical the level.
+        if event.type == tk.EventType.ButtonRelease:
+            self.window_start = None
+            return
+        if self.window_start is not None:
+            x, y = self.window_start
+            level, width = self.windows[self.vars.phase.get()]
+            self.set_window(level - (event.y - y), width + 2 * (event.x - x))
+        self.window_start = event.x, event.y
+
+    def reset_zoom(self, *args):
+        self.zoom = 1.0
+        self.center = None
         self.trigger_draw()
 
+    def evict_case(self, entry: SimpleNamespace):
+        self.base_image_reqque.put(SimpleNamespace(close=entry.handle))
+        self.over_image_editque.put(SimpleNamespace(close=entry.handle, spill=nu.edited_path(entry.path)))
+
     def trigger_draw(self, *args):
         # print("-- trigger draw --")
         self.base_image_reqque.put(
             SimpleNamespace(
+                handle=self.handle,
                 flip_x=self.vars.flip_x.get(),
                 flip_y=self.vars.flip_y.get(),
-                resolution=self.resolution,
+                resolution=self.vars.resolution.get(),
+                resample=self.vars.base_resample.get(),
+                tiled=self.vars.tiled.get(),
+                box=self.viewport_box(),
+                windows=[self.windows[phase] for phase in range(4)],
+                layout=self.vars.layout.get(),
+                plane=self.shown_plane,
                 phase=self.vars.phase.get(),
                 swap_xy=self.vars.swap_xy.get(),
                 z=self.vars.z.get(),
+                lod=self.scrolling,
+                sent=time.perf_counter(),
             )
         )
         self.trigger_overdraw()
@@ -212,14 +488,27 @@ class MainWindow(tk.Tk):
         # print("-- trigger overdraw --")
         self.over_image_drawque.put(
             SimpleNamespace(
+                handle=self.handle,
                 flip_x=self.vars.flip_x.get(),
                 flip_y=self.vars.flip_y.get(),
-                resolution=self.resolution,
+                resolution=self.vars.resolution.get(),
+                resample=self.vars.over_resample.get(),
+                tiled=self.vars.tiled.get(),
+                box=self.viewport_box(),
+                plane=self.shown_plane,
+                layout=self.vars.layout.get(),
                 swap_xy=self.vars.swap_xy.get(),
                 z=self.vars.z.get(),
+                lod=self.scrolling,
+                sent=time.perf_counter(),
             )
         )
 
+    def set_resolution(self, *args):
+        resolution = self.vars.resolution.get()
+        self.canvas.config(height=resolution, width=resolution)
+        self.trigger_draw()
+
     def load_local_segm(self):
         filetypes = (
             ('Compressed nifti', '*.nii.gz'),
@@ -232,15 +521,16 @@ class MainWindow(tk.Tk):
         )
 
         affine, bottom, top, height = nu.load_registration_data(
-            self.tmpdir_path)
+            self.case_path)
         segm = nu.load_ndarray(Path(filename))
-        import torch
-        import lovely_tensors as lt
-        print("segm", filename, (bottom, top), lt.lovely(torch.tensor(segm)))
+        print("segm", filename, (bottom, top), segm.shape)
         segm = segm[..., bottom:top]
-        segm = segm.astype(np.int64)
-        self.start_over_image_process(segm)
-        self.trigger_overdraw()
+        self.over_image_editque.put(
+            SimpleNamespace(
+                handle=self.handle,
+                replace=segm.astype(np.uint8),
+            )
+        )
 
     def overwrite_drive_segm(self):
         from .gdrive_screen import states
@@ -255,20 +545,28 @@ class MainWindow(tk.Tk):
         )
 
     def set_brush(self, *args):
-        radius = self.vars.brush_radius.get()
-        side = 2 * radius + 1
-        self.brush = np.array([
-            [int((i - radius) ** 2 + (j - radius) ** 2 < (radius + 1) ** 2)
-             for j in range(side)]
-            for i in range(side)
-        ])
+        self.over_image_editque.put(
+            SimpleNamespace(
+                set_brush=(
+                    self.vars.brush_shape.get(),
+                    self.vars.brush_radius.get(),
+                    self.vars.brush_hardness.get(),
+                )
+            )
+        )
 
     def clear_segm(self, *args):
-        self.start_over_image_process(np.zeros(self.case_shape))
+        self.over_image_editque.put(
+            SimpleNamespace(
+                handle=self.handle,
+                clear=True,
+            )
+        )
 
     def flip_segm(self, *args, axis=0):
         self.over_image_editque.put(
             SimpleNamespace(
+                handle=self.handle,
                 flipaxis=axis
             )
         )
@@ -276,10 +574,23 @@ class MainWindow(tk.Tk):
     def translate(self, *args, delta=0):
         self.over_image_editque.put(
             SimpleNamespace(
+                handle=self.handle,
                 translate=delta
             )
         )
 
+    def propagate(self, *args, steps=10):
+        self.over_image_editque.put(
+            SimpleNamespace(
+                handle=self.handle,
+                propagate=steps,
+                tolerance=self.vars.fill_tolerance.get(),
+                phase=self.vars.phase.get(),
+                plane=self.shown_plane,
+                z=self.vars.z.get(),
+            )
+        )
+
     def merge_mask(self, *args, index: int):
         filetypes = (
             ('Nifti', '*.nii'),
@@ -290,29 +601,39 @@ class MainWindow(tk.Tk):
             filetypes=filetypes,
         )
         self.over_image_editque.put(SimpleNamespace(
+            handle=self.handle,
             mask=nu.load_ndarray(Path(filename)),
             shape=self.case_shape,
             index=index,
         ))
     
     def click(self, event, *args):
-        self.over_image_editque.put(
-                SimpleNamespace(
-                    event=SimpleNamespace(
-                        canvas_size=(event.widget.winfo_width(), event.widget.winfo_height()),
-                        x=event.x,
-                        y=event.y
-                    ),
-                    scan_size=self.case_shape[-2],
-                    brush=self.brush,
-                    swap_xy=self.vars.swap_xy.get(),
-                    flip_x=self.vars.flip_x.get(),
-                    flip_y=self.vars.flip_y.get(),
-                    r=self.vars.brush_radius.get(),
-                    z=self.vars.z.get(),
-                    resolution=self.resolution,
-                )
-            )
+        point = render.canvas_to_cell(event.x, event.y, self.vars.resolution.get(), self.vars.layout.get())
+        if point is None:
+            return
+        request = SimpleNamespace(
+            handle=self.handle,
+            event=SimpleNamespace(
+                canvas_size=(event.widget.winfo_width(), event.widget.winfo_height()),
+                x=point[0],
+                y=point[1]
+            ),
+            box=self.viewport_box(),
+            swap_xy=self.vars.swap_xy.get(),
+            flip_x=self.vars.flip_x.get(),
+            flip_y=self.vars.flip_y.get(),
+            plane=self.shown_plane,
+            z=self.vars.z.get(),
+            resolution=self.vars.resolution.get(),
+            sent=time.perf_counter(),
+        )
+        if self.vars.brush_tool.get() == "fill":
+            if event.type != tk.EventType.ButtonPress:
+                return
+            request.fill = self.vars.fill_tolerance.get()
+            request.extent = 64
+            request.phase = self.vars.phase.get()
+        self.over_image_editque.put(request)
 
 
 def mouse_wheel(root):
@@ -329,3 +650,16 @@ def mouse_wheel(root):
         def _mouse_wheel(root, event):
             root.move(event.delta // 120)
     return _mouse_wheel
+
+
+def zoom_wheel(root):
+    if platform == "linux" or platform == "linux2":
+        def _zoom_wheel(event):
+            if event.num == 4:
+                root.zoom_at(1.25, event.x, event.y)
+            elif event.num == 5:
+                root.zoom_at(0.8, event.x, event.y)
+    else:
+        def _zoom_wheel(event):
+            root.zoom_at(1.25 if event.delta > 0 else 0.8, event.x, event.y)
+    return _zoom_wheel
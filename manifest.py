@@ -0,0 +1,126 @@
+"""Manifest of the trainable cases of a Drive folder, with file ids, sizes and checksums, split in train and valid.
+
+    python -m frontend_liver.manifest manifest.json [--valid 10] [--fold 0] [--parquet manifest.parquet]
+
+A case goes in valid when the hash of its path, modulo `valid`, is `fold`: the split does not depend on
+the order of discovery, and a case keeps its side when others are added. Training jobs read the manifest
+and fetch cases by file id with `fetch_case`, without walking the folders again.
+"""
+import argparse
+import hashlib
+import json
+import time
+from pathlib import Path
+from typing import Iterator
+
+from . import pydrive_utils as pu
+
+SOURCES_ROOT = "1N5UQx2dqvWy1d6ve1TEgEFthE8tEApxq"
+CASE_FILES = [f"registered_phase_{phase}.nii.gz" for phase in ["b", "a", "v", "t"]] + ["segmentation.nii.gz"]
+
+
+def split_of(case: str, valid: int, fold: int) -> str:
+    digest = hashlib.md5(case.encode()).digest()
+    return "valid" if int.from_bytes(digest[:8], "big") % valid == fold else "train"
+
+
+def case_record(case: str, folder: pu.DrivePath, items: list, valid: int, fold: int) -> dict:
+    files = {item["title"]: item for item in items}
+    return dict(
+        case=case,
+        id=folder.obj.get("id"),
+        split=split_of(case, valid, fold),
+        files={
+            name: dict(id=files[name]["id"], size=int(files[name].get("fileSize", 0)),
+                       md5=files[name].get("md5Checksum"))
+            for name in CASE_FILES
+        },
+    )
+
+
+def build(path: pu.DrivePath, valid: int = 10, fold: int = 0, threads: int = 8) -> dict:
+    """Discover the trainable cases under `path` concurrently, and describe them sorted by case."""
+    cases = [
+        case_record(str(folder.relative_to(path)), folder, items, valid, fold)
+        for folder, items in pu.walk(path, pu.has_trainable, threads)
+    ]
+    cases.sort(key=lambda record: record["case"])
+    return dict(
+        root=path.root,
+        path=str(path),
+        created=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        valid=valid,
+        fold=fold,
+        cases=cases,
+    )
+
+
+def write_json(manifest: dict, target: Path):
+    partial = target.with_name(target.name + ".part")
+    with open(partial, "w") as f:
+        json.dump(manifest, f, indent=1)
+    partial.replace(target)
+
+
+def write_parquet(manifest: dict, target: Path):
+    """One row per file. Needs pyarrow, which is not a requirement of the app."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    rows = [
+        dict(case=record["case"], split=record["split"], title=title, **file)
+        for record in manifest["cases"]
+        for title, file in record["files"].items()
+    ]
+    table = pa.Table.from_pylist(rows).replace_schema_metadata(
+        {key: str(value) for key, value in manifest.items() if key != "cases"})
+    pq.write_table(table, target)
+
+
+def load(source: Path) -> dict:
+    with open(source) as f:
+        return json.load(f)
+
+
+def iter_split(manifest: dict, split: str) -> Iterator[dict]:
+    yield from (record for record in manifest["cases"] if record["split"] == split)
+
+
+def fetch_case(record: dict, target: Path, check: bool = True) -> Path:
+    """Download the files of a manifest case by id into `target`, checking their md5 where there is one."""
+    from . import nibabel_utils as nu
+    target.mkdir(parents=True, exist_ok=True)
+    for title, file in record["files"].items():
+        pu.drive.CreateFile(dict(id=file["id"])).GetContentFile(str(target / title))
+        if check and file["md5"] and nu.file_md5(target / title) != file["md5"]:
+            raise IOError(f"Checksum mismatch for {record['case']}/{title}.")
+    return target
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("target", type=Path, help="JSON manifest to write.")
+    parser.add_argument("--root", default=SOURCES_ROOT, help="Id of the Drive folder holding `path`.")
+    parser.add_argument("--path", default="sources")
+    parser.add_argument("--valid", type=int, default=10, help="One case in `valid` goes in the valid split.")
+    parser.add_argument("--fold", type=int, default=0, help="Which of the `valid` folds is the valid split.")
+    parser.add_argument("--threads", type=int, default=8, help="Folder listings at once.")
+    parser.add_argument("--parquet", type=Path, default=None, help="Also write a table with a row per file.")
+    parser.add_argument("--mock", type=Path, default=None, help="Local folder to read through a MockDrive instead.")
+    args = parser.parse_args()
+
+    pu.connect(mock=args.mock is not None)
+    if args.mock is not None:
+        pu.drive = pu.MockDrive(args.mock)
+        args.root = "root"
+    start = time.perf_counter()
+    manifest = build(pu.DrivePath([args.path], root=args.root), args.valid, args.fold, args.threads)
+    write_json(manifest, args.target)
+    if args.parquet:
+        write_parquet(manifest, args.parquet)
+    n_valid = sum(1 for _ in iter_split(manifest, "valid"))
+    print(f"{len(manifest['cases'])} cases ({len(manifest['cases']) - n_valid} train, {n_valid} valid) "
+          f"in {time.perf_counter() - start:.1f} s.")
+
+
+if __name__ == "__main__":
+    main()
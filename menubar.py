@@ -2,6 +2,7 @@ import tkinter as tk
 from functools import partial
 
 from .mainwindow import MainWindow
+from .render import WINDOW_PRESETS
 
 class Menubar(tk.Menu):
     def __init__(self, root: MainWindow):
@@ -68,6 +69,10 @@ class Menubar(tk.Menu):
             variable=root.vars.flip_y
         )
         menu_view.add_separator()
+        menu_view.add_command(label="Which plane to show", state="disabled")
+        for plane in ["axial", "coronal", "sagittal"]:
+            menu_view.add_radiobutton(label=plane.capitalize(), variable=root.vars.plane, value=plane)
+        menu_view.add_separator()
         menu_view.add_command(label="Which phase to show", state="disabled")
         phases = [
             ("Basale", 0),
@@ -77,9 +82,69 @@ class Menubar(tk.Menu):
         ]
         for phase_name, val in phases:
             menu_view.add_radiobutton(label=phase_name, variable=root.vars.phase, value=val)
+        menu_layout = tk.Menu(menu_view)
+        menu_view.add_cascade(menu=menu_layout, label="Phases layout")
+        layouts = [
+            ("Selected phase", "single"),
+            ("Arteriosa | Venosa", "pair"),
+            ("All four phases", "quad"),
+            ("Arteriosa + Venosa, mixed", "mix"),
+            ("Arteriosa + Venosa, magenta/green", "fusion"),
+        ]
+        for label, val in layouts:
+            menu_layout.add_radiobutton(label=label, variable=root.vars.layout, value=val)
+        menu_window = tk.Menu(menu_view)
+        menu_view.add_cascade(menu=menu_window, label="Window of this phase (right drag)")
+        for label, (level, width) in WINDOW_PRESETS.items():
+            menu_window.add_command(
+                label=f"{label} (L {level:g}, W {width:g})",
+                command=partial(root.set_window, level, width)
+            )
+        menu_view.add_separator()
+        menu_view.add_command(label="Reset zoom (0)", command=root.reset_zoom)
+        menu_view.add_command(label="Next labelled slice (PgDn)", command=lambda: root.jump_labelled(1))
+        menu_view.add_command(label="Previous labelled slice (PgUp)", command=lambda: root.jump_labelled(-1))
+        menu_view.add_separator()
+        menu_view.add_checkbutton(label="Frame timings overlay (F3)", variable=root.vars.show_hud)
+        menu_view.add_command(label="Save frame timings...", command=root.dump_timings)
+        menu_view.add_separator()
+        menu_view.add_command(label="Canvas resolution", state="disabled")
+        for resolution in [800, 1200, 1600, 2000]:
+            menu_view.add_radiobutton(label=f"{resolution}px", variable=root.vars.resolution, value=resolution)
+        menu_view.add_checkbutton(
+            label="Tiled rendering",
+            onvalue=1,
+            offvalue=0,
+            variable=root.vars.tiled
+        )
+        menu_base_resample = tk.Menu(menu_view)
+        menu_over_resample = tk.Menu(menu_view)
+        menu_view.add_cascade(menu=menu_base_resample, label="Scan resampling")
+        menu_view.add_cascade(menu=menu_over_resample, label="Segmentation resampling")
+        for resample in ["nearest", "bilinear", "bicubic", "lanczos"]:
+            menu_base_resample.add_radiobutton(
+                label=resample.capitalize(), variable=root.vars.base_resample, value=resample)
+            menu_over_resample.add_radiobutton(
+                label=resample.capitalize(), variable=root.vars.over_resample, value=resample)
 
         menu_brush = tk.Menu(self)
         self.add_cascade(menu=menu_brush, label='Brush options')
+        menu_brush.add_command(label="The tool", state="disabled")
+        tools = [
+            ("Brush", "brush"),
+            ("Region fill (3D, on scan intensity)", "fill"),
+        ]
+        for label, val in tools:
+            menu_brush.add_radiobutton(label=label, variable=root.vars.brush_tool, value=val)
+        menu_fill = tk.Menu(menu_brush)
+        menu_brush.add_cascade(menu=menu_fill, label="Fill tolerance")
+        for val in (10, 20, 40, 80):
+            menu_fill.add_radiobutton(label=f"± {val}", variable=root.vars.fill_tolerance, value=val)
+        menu_brush.add_command(
+            label="Propagate to the next 10 slices (Ctrl+Up)", command=partial(root.propagate, steps=10))
+        menu_brush.add_command(
+            label="Propagate to the previous 10 slices (Ctrl+Down)", command=partial(root.propagate, steps=-10))
+        menu_brush.add_separator()
         menu_brush.add_command(label="The brush action", state="disabled")
         actions = [
             ("Paint liver", 1),
@@ -101,4 +166,22 @@ class Menubar(tk.Menu):
             ("Radius 20", 20),
         ]
         for label, val in brushes:
-            menu_brush.add_radiobutton(label=label, variable=root.vars.brush_radius, value=val)
\ No newline at end of file
+            menu_brush.add_radiobutton(label=label, variable=root.vars.brush_radius, value=val)
+        menu_brush.add_separator()
+        menu_brush.add_command(label="The shape of the brush", state="disabled")
+        shapes = [
+            ("Circle", "circle"),
+            ("Square", "square"),
+            ("Sphere (across slices)", "sphere"),
+        ]
+        for label, val in shapes:
+            menu_brush.add_radiobutton(label=label, variable=root.vars.brush_shape, value=val)
+        menu_brush.add_separator()
+        menu_brush.add_command(label="The hardness of the brush", state="disabled")
+        hardnesses = [
+            ("Hard", 1.0),
+            ("Medium", 0.75),
+            ("Soft", 0.5),
+        ]
+        for label, val in hardnesses:
+            menu_brush.add_radiobutton(label=label, variable=root.vars.brush_hardness, value=val)
\ No newline at end of file
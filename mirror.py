@@ -0,0 +1,206 @@
+"""Local mirror of a Drive folder, kept in sync in both directions.
+
+    python -m frontend_liver.mirror LOCAL_ROOT [--path sources] [--pull | --push] [--transfers 4]
+
+LOCAL_ROOT/.mirror.json records, for every synced file, its Drive id and checksum and the size and
+mtime of the local copy at the last sync. A file changed on Drive since then is downloaded, a file
+changed locally is uploaded, and a file changed on both sides is reported and left alone. Transfers run
+on an IOLoop, at most --transfers at once; the record is saved as they complete, so an interrupted sync
+resumes where it stopped.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+from pathlib import Path
+
+from . import pydrive_utils as pu
+from .io_loop import IOLoop
+
+SOURCES_ROOT = "1N5UQx2dqvWy1d6ve1TEgEFthE8tEApxq"
+RECORD = ".mirror.json"
+
+
+def fingerprint(metadata: dict) -> str:
+    """What changes when the content of a Drive file does: its md5, else its size and modification time."""
+    return metadata.get("md5Checksum") or f"{metadata.get('fileSize')}@{metadata.get('modifiedDate')}"
+
+
+def remote_files(path: pu.DrivePath, threads: int = 8) -> tuple[dict, dict]:
+    """Metadata of the files under `path` and ids of its folders, by path relative to it."""
+    files, folders = {}, {"": path.id}
+    for folder, items in pu.walk(path, lambda names: True, threads, prune=False):
+        parts = folder.relative_to(path).parts
+        for item in items:
+            relative = "/".join(parts + [item["title"]])
+            if item.get("mimeType") == pu.FOLDER:
+                folders[relative] = item["id"]
+            else:
+                files[relative] = dict(item)
+    return files, folders
+
+
+def local_files(root: Path) -> dict:
+    return {
+        path.relative_to(root).as_posix(): path.stat()
+        for path in root.rglob("*")
+        if path.is_file() and path.name != RECORD and not path.name.endswith(".part")
+    }
+
+
+def load_record(root: Path) -> dict:
+    try:
+        with open(root / RECORD) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_record(root: Path, record: dict):
+    partial = root / (RECORD + ".part")
+    with open(partial, "w") as f:
+        json.dump(record, f)
+    partial.replace(root / RECORD)
+
+
+def entry(file_id: str, remote: str, stat: os.stat_result) -> dict:
+    return dict(id=file_id, remote=remote, size=stat.st_size, mtime=stat.st_mtime_ns)
+
+
+def plan(root: Path, remote: dict, local: dict, record: dict) -> dict:
+    """Files to download, to upload, changed on both sides, or deleted on one side and left on the other.
+
+    Files found in sync are added to `record`; deletions are not propagated.
+    """
+    from .nibabel_utils import file_md5
+    actions = dict(download=[], upload=[], conflict=[], deleted=[])
+    for name in sorted(set(remote) | set(local)):
+        known = record.get(name)
+        on_drive, here = remote.get(name), local.get(name)
+        drive_changed = on_drive is not None and (known is None or fingerprint(on_drive) != known["remote"])
+        local_changed = here is not None and (
+            known is None or (here.st_size, here.st_mtime_ns) != (known["size"], known["mtime"]))
+        if drive_changed and local_changed:
+            # Never synced, or changed on both sides: in sync only if the contents match.
+            if on_drive.get("md5Checksum") == file_md5(root / name):
+                record[name] = entry(on_drive["id"], fingerprint(on_drive), here)
+            else:
+                actions["conflict"].append(name)
+        elif drive_changed:
+            actions["download"].append(name)
+        elif local_changed:
+            actions["upload"].append(name)
+        elif on_drive is None or here is None:
+            actions["deleted"].append(name)
+    return actions
+
+
+def download(root: Path, name: str, metadata: dict) -> dict:
+    target = root / name
+    target.parent.mkdir(parents=True, exist_ok=True)
+    partial = target.with_name(target.name + ".part")
+    pu.drive.CreateFile(dict(id=metadata["id"])).GetContentFile(str(partial))
+    partial.replace(target)
+    return entry(metadata["id"], fingerprint(metadata), target.stat())
+
+
+def upload(root: Path, name: str, file_id: str = None, parent_id: str = None) -> dict:
+    source = root / name
+    stat = source.stat()
+    if file_id is not None:
+        f = pu.drive.CreateFile(dict(id=file_id))
+    else:
+        f = pu.drive.CreateFile(dict(title=source.name, parents=[{"id": parent_id}]))
+    f.SetContentFile(str(source))
+    f.Upload()
+    return entry(f["id"], fingerprint(f), stat)
+
+
+def folder_id(path: pu.DrivePath, folders: dict, relative: str) -> str:
+    """Id of the Drive folder `relative` to `path`, made with its parents if missing. Not thread safe."""
+    if relative not in folders:
+        folders[relative] = (path / relative).mkdir().id
+    return folders[relative]
+
+
+async def transfer(io: IOLoop, root: Path, record: dict, jobs: list, save_every: float = 5) -> list:
+    """Run (name, fn, args) jobs within the "drive" limit, storing their entries in `record`. Returns the failures."""
+    async def run(name, fn, args):
+        try:
+            return name, await io.blocking(fn, root, name, *args, limit="drive"), None
+        except Exception as err:
+            return name, None, err
+
+    failed, saved = [], time.monotonic()
+    for i, done in enumerate(asyncio.as_completed([run(*job) for job in jobs])):
+        name, result, err = await done
+        if err is None:
+            record[name] = result
+        else:
+            failed.append((name, err))
+        print(f"[{i + 1}/{len(jobs)}] {'failed' if err else 'ok'} {name}" + (f": {err}" if err else ""))
+        if time.monotonic() - saved > save_every:
+            save_record(root, record)
+            saved = time.monotonic()
+    save_record(root, record)
+    return failed
+
+
+def sync(path: pu.DrivePath, root: Path, pull: bool = True, push: bool = True, transfers: int = 4,
+         threads: int = 8, dry_run: bool = False) -> dict:
+    root.mkdir(parents=True, exist_ok=True)
+    record = load_record(root)
+    remote, folders = remote_files(path, threads)
+    actions = plan(root, remote, local_files(root), record)
+    jobs = []
+    if pull:
+        jobs += [(name, download, (remote[name],)) for name in actions["download"]]
+    if push:
+        for name in actions["upload"]:
+            if name in remote:
+                jobs.append((name, upload, (remote[name]["id"],)))
+            elif not dry_run:
+                jobs.append((name, upload, (None, folder_id(path, folders, name.rpartition("/")[0]))))
+    print(f"{len(remote)} files on Drive, {len(jobs)} to transfer, {len(actions['conflict'])} conflicts, "
+          f"{len(actions['deleted'])} deleted on one side.")
+    for kind in ["conflict", "deleted"]:
+        for name in actions[kind]:
+            print(f"  {kind}", name)
+    if dry_run:
+        return dict(actions, failed=[])
+    io = IOLoop(limits=dict(drive=transfers))
+    try:
+        failed = io.submit(transfer(io, root, record, jobs)).result()
+    finally:
+        io.stop()
+    return dict(actions, failed=failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("local_root", type=Path)
+    parser.add_argument("--root", default=SOURCES_ROOT, help="Id of the Drive folder holding `path`.")
+    parser.add_argument("--path", default="sources")
+    direction = parser.add_mutually_exclusive_group()
+    direction.add_argument("--pull", action="store_true", help="Only download.")
+    direction.add_argument("--push", action="store_true", help="Only upload.")
+    parser.add_argument("--transfers", type=int, default=4, help="Transfers at once.")
+    parser.add_argument("--threads", type=int, default=8, help="Folder listings at once.")
+    parser.add_argument("--dry-run", action="store_true", help="Only tell what would be transferred.")
+    parser.add_argument("--mock", type=Path, default=None, help="Local folder to sync with through a MockDrive instead.")
+    args = parser.parse_args()
+
+    pu.connect(mock=args.mock is not None)
+    if args.mock is not None:
+        pu.drive = pu.MockDrive(args.mock)
+        args.root = "root"
+    start = time.perf_counter()
+    result = sync(pu.DrivePath([args.path], root=args.root), args.local_root, pull=not args.push,
+                  push=not args.pull, transfers=args.transfers, threads=args.threads, dry_run=args.dry_run)
+    print(f"Done in {time.perf_counter() - start:.1f} s, {len(result['failed'])} failed.")
+    raise SystemExit(1 if result["failed"] or result["conflict"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,65 @@
 from __future__ import annotations
 
+import gzip
+import hashlib
 import pickle
 from pathlib import Path
+from typing import Callable
 
-import nibabel
 import numpy as np
 
 
 def load_ndarray(file_path: Path) -> np.ndarray:
+    import nibabel
     image = nibabel.load(file_path)
     return np.array(image.dataobj, dtype=np.int16)
 
 
+def decoded_path(file_path: Path) -> Path:
+    return file_path.with_name(file_path.name.split(".")[0] + ".npy")
+
+
+def is_fresh(copy_path: Path, file_path: Path) -> bool:
+    """True if `copy_path` exists and is not older than `file_path` (or that is missing)."""
+    if not copy_path.exists():
+        return False
+    return not file_path.exists() or copy_path.stat().st_mtime >= file_path.stat().st_mtime
+
+
+def load_decoded(file_path: Path) -> np.ndarray:
+    """Like load_ndarray, but reads the decoded .npy copy if it is not older than the nifti."""
+    decoded = decoded_path(file_path)
+    if is_fresh(decoded, file_path):
+        return np.load(decoded)
+    return load_ndarray(file_path)
+
+
+# Planes per slab of the edit tracking and of the patches.
+PATCH_SLAB = 8
+
+
+def patch_path(case_path: Path) -> Path:
+    """Where the edited slabs of the segmentation go, as a patch of segmentation.nii.gz (see write_patch)."""
+    return case_path / "segmentation.patch.npz"
+
+
+def edited_path(case_path: Path) -> Path:
+    """Where the overlay worker spills unsaved edits of an evicted case (already cut to bottom:top)."""
+    return case_path / "edited_segmentation.npy"
+
+
+def decode(case_path: Path):
+    """Store a .npy copy of each nifti in `case_path`, so that the next load skips gzip."""
+    for file_path in case_path.glob("*.nii.gz"):
+        decoded = decoded_path(file_path)
+        partial = decoded.with_name(decoded.name + ".part")
+        with open(partial, "wb") as f:
+            np.save(f, load_ndarray(file_path))
+        partial.replace(decoded)
+
+
 def save_segmentation(segm: np.ndarray, case_path: Path):
+    import nibabel
     affine, bottom, top, height = load_registration_data(case_path)
     background = np.zeros([*segm.shape[:-1], height])
     background[..., bottom:top] = segm
@@ -25,36 +72,148 @@ def save_segmentation(segm: np.ndarray, case_path: Path):
     )
 
 
+def stream_segmentation(read: Callable[[int, int], np.ndarray], shape: tuple, case_path: Path,
+                        slab: int = 16) -> tuple[Path, str]:
+    """Write segmentation.nii.gz like save_segmentation, as uint8, reading `slab` z-planes at a time.
+
+    `read(start, stop)` returns the planes start:stop of the (x, y, z) segmentation of `shape`.
+    NIfTI data is in Fortran order, so z-slabs are contiguous in the file and are written one after
+    the other. Returns the path and the md5 of the file.
+    """
+    import nibabel
+    affine, bottom, top, height = load_registration_data(case_path)
+    image = nibabel.Nifti1Image(np.zeros((1, 1, 1), dtype=np.uint8), affine=affine)
+    image.header.set_data_shape((*shape[:-1], height))
+    target = case_path / "segmentation.nii.gz"
+    partial = target.with_name(target.name + ".part")
+    with gzip.open(partial, "wb", compresslevel=6) as f:
+        image.header.write_to(f)
+        f.write(bytes(int(image.header["vox_offset"]) - f.tell()))
+        for start in range(0, height, slab):
+            stop = min(start + slab, height)
+            planes = np.zeros((*shape[:-1], stop - start), dtype=np.uint8)
+            lo, hi = max(start, bottom), min(stop, top)
+            if lo < hi:
+                planes[..., lo - start:hi - start] = read(lo - bottom, hi - bottom)
+            f.write(planes.tobytes(order="F"))
+    md5 = file_md5(partial)
+    partial.replace(target)
+    return target, md5
+
+
+def file_md5(path: Path) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def write_patch(read: Callable[[int, int], np.ndarray], slabs: list, case_path: Path) -> tuple[Path, str]:
+    """Write the segmentation slabs `slabs` (of PATCH_SLAB planes, from bottom) as a patch of segmentation.nii.gz.
+
+    `read(start, stop)` returns the planes start:stop of the segmentation, cut to bottom:top. The patch
+    holds the md5 of the base it applies to, the absolute z of its planes and the planes themselves,
+    compressed. It replaces the previous patch, so it must hold all the slabs edited since the base.
+    Returns the path and the md5 of the file.
+    """
+    _, bottom, top, _ = load_registration_data(case_path)
+    spans = [(slab * PATCH_SLAB, min((slab + 1) * PATCH_SLAB, top - bottom)) for slab in sorted(slabs)]
+    target = patch_path(case_path)
+    partial = target.with_name(target.name + ".part")
+    with open(partial, "wb") as f:
+        np.savez_compressed(
+            f,
+            base=file_md5(case_path / "segmentation.nii.gz"),
+            z=np.concatenate([np.arange(start, stop) for start, stop in spans]) + bottom,
+            planes=np.concatenate([np.uint8(read(start, stop)) for start, stop in spans], axis=-1),
+        )
+    md5 = file_md5(partial)
+    partial.replace(target)
+    return target, md5
+
+
+def apply_patch(segm: np.ndarray, case_path: Path, bottom: int) -> list:
+    """Copy the planes of the patch into `segm` (cut to bottom:top) if the patch was made for the base
+    segmentation.nii.gz next to it. Returns the slabs that the patch changes."""
+    if not patch_path(case_path).exists() or not (case_path / "segmentation.nii.gz").exists():
+        return []
+    with np.load(patch_path(case_path)) as patch:
+        if str(patch["base"]) != file_md5(case_path / "segmentation.nii.gz"):
+            print("Segmentation patch ignored: it was made for another base.")
+            return []
+        z = patch["z"] - bottom
+        segm[..., z] = patch["planes"]
+    return sorted(set((z // PATCH_SLAB).tolist()))
+
+
+def patch_base(case_path: Path) -> str:
+    """md5 of the segmentation.nii.gz that the patch of the case applies to."""
+    with np.load(patch_path(case_path)) as patch:
+        return str(patch["base"])
+
+
+def merge_patch(case_path: Path) -> tuple[Path, str]:
+    """Write segmentation.nii.gz with the patch applied, as a whole save would, and remove the patch.
+
+    Returns the path and the md5 of the file.
+    """
+    _, bottom, top, _ = load_registration_data(case_path)
+    segm = load_ndarray(case_path / "segmentation.nii.gz")[..., bottom:top]
+    apply_patch(segm, case_path, bottom)
+    target, md5 = stream_segmentation(lambda start, stop: segm[..., start:stop], segm.shape, case_path)
+    patch_path(case_path).unlink()
+    return target, md5
+
+
 def load_registration_data(case_path: Path) -> tuple[np.ndarray, int, int, int]:
     with open(case_path / "registration_data.pickle", "rb") as f:
         d = pickle.load(f)
     return d["affine"], d["bottom"], d["top"], d["height"]
 
 
-def load(case_path: Path, scan: bool = True, segm: bool = False, clip: tuple[int, int] = None) -> dict:
+def load(case_path: Path, scan: bool = True, segm: bool = False, clip: tuple[int, int] = None,
+         dtype=np.float32) -> dict:
+    from . import chunked
     print(f"Loading {case_path}...")
     name = str(case_path.name)
     _, bottom, top, _ = load_registration_data(case_path)
+    # Chunks are read when fresher than the niftis, unless there is a decoded copy, which is faster still.
+    meta_path = chunked.chunks_path(case_path) / "meta.json"
+    first_phase = case_path / "registered_phase_b.nii.gz"
     if scan:
-        scan = np.stack([
-            load_ndarray(case_path / f"registered_phase_{phase}.nii.gz")
-            for phase in ["b", "a", "v", "t"]
-        ])
-        scan = scan[..., bottom:top]
+        if is_fresh(meta_path, first_phase) and not is_fresh(decoded_path(first_phase), first_phase):
+            scan = chunked.load(case_path, scan=True)["scan"]
+        else:
+            scan = np.stack([
+                load_decoded(case_path / f"registered_phase_{phase}.nii.gz")
+                for phase in ["b", "a", "v", "t"]
+            ])
+            scan = scan[..., bottom:top]
         if clip:
             np.clip(scan, *clip, out=scan)
-        scan = scan.astype(np.float32)
+        scan = scan.astype(dtype)
     else:
         scan = None
 
+    # Slabs of the segmentation that differ from segmentation.nii.gz, None if unknown.
+    dirty = []
     try:
         assert segm
-        segm = load_ndarray(case_path / f"segmentation.nii.gz")
+        if is_fresh(edited_path(case_path), case_path / "segmentation.nii.gz"):
+            segm = np.load(edited_path(case_path))
+            dirty = None
+        elif is_fresh(meta_path, case_path / "segmentation.nii.gz") and "segm" in chunked.read_meta(case_path)["volumes"]:
+            segm = chunked.load(case_path, scan=False, segm=True)["segm"]
+            dirty = apply_patch(segm, case_path, bottom)
+        else:
+            segm = load_decoded(case_path / f"segmentation.nii.gz")
+            segm = segm[..., bottom:top]
+            dirty = apply_patch(segm, case_path, bottom)
         assert np.all(segm < 3), "Segmentation has indices above 2."
-        segm = segm[..., bottom:top]
         segm = segm.astype(np.int64)
     except (FileNotFoundError, AssertionError) as err:
         print("Error loading segmentation.", err)
         segm = None
 
-    return dict(scan=scan, segm=segm, name=name)
+    return dict(scan=scan, segm=segm, name=name, dirty=dirty)
@@ -4,14 +4,40 @@ import time
 from pathlib import Path
 from types import SimpleNamespace
 from typing import Literal
-import torch
 import numpy as np
 from PIL import Image
 import queue
 
+from . import brush, label_stats, nibabel_utils, processes, regions, render, timing
+from .label_store import BlockLabels
 from .shared_ndarray import SharedNdarray
 
 
+def flip(segm: np.ndarray, axis: int) -> np.ndarray:
+    return np.flip(segm, axis=axis)
+
+
+def translate(segm: np.ndarray, delta: int) -> np.ndarray:
+    """`segm` moved by `delta` planes along z, with background coming in."""
+    back = np.zeros_like(segm)
+    if delta > 0:
+        back[..., delta:] = segm[..., :-delta]
+    elif delta < 0:
+        back[..., :delta] = segm[..., -delta:]
+    else:
+        back[...] = segm
+    return back
+
+
+def merge_mask(segm: np.ndarray, mask: np.ndarray, index: int) -> np.ndarray:
+    """`segm` with label `index` where `mask` is set; the mask is cut or padded along z to the segmentation."""
+    full = np.zeros(segm.shape)
+    mask = np.clip(mask, 0, 1)
+    top = min(mask.shape[-1], full.shape[-1])
+    full[..., :top] = mask[..., :top]
+    return np.uint8(full * index + (1 - full) * segm)
+
+
 class Worker:
     def __init__(
             self,
@@ -19,20 +45,18 @@ class Worker:
             edit_queue: multiprocessing.Queue,
             return_queue: multiprocessing.Queue, 
             save_queue: multiprocessing.Queue, 
-            data: np.ndarray,
+            stats_queue: multiprocessing.Queue = None,
+            timings: timing.Ring = timing.OFF,
             ):
-        self._is_alive = multiprocessing.Value(ctypes.c_bool, True)
+        self._is_alive = processes.context().Value(ctypes.c_bool, True)
         self.draw_queue = draw_queue
         self.edit_queue = edit_queue
         self.save_queue = save_queue
+        self.stats_queue = stats_queue
+        self.timings = timings
         self.return_queue = return_queue
-        if data is None:
-            data = np.zeros((512, 512, 1)).astype(np.uint8)
-        self.data = data
-        import lovely_tensors as lt
-        print("New OIWorker with", lt.lovely(torch.tensor(data)))
 
-        self._process = multiprocessing.Process(target=self.run)
+        self._process = processes.context().Process(target=self.run)
         self._process.start()
 
     def get_is_alive(self):
@@ -46,83 +70,235 @@ class Worker:
     is_alive = property(get_is_alive, set_is_alive)
 
     def run(self):
-        segm = self.data
+        segms = {}
+        scans = {}
+        stats = {}
+        recount = set()
+        updated = set()
+        edited = set()
+        dirty = {}  # slabs changed since the segmentation was last saved whole
+        levels = {}  # max pooled labels by render.LOD_FACTORS of the segmentation on screen, built when idle
+        building = {}  # handle: first plane of its levels not built yet
         draw_parameters = SimpleNamespace(
+            handle=None,
             swap_xy=True,
             flip_x=True,
             flip_y=False,
             resolution=800,
+            resample="bicubic",
+            tiled=False,
+            box=None,
+            plane="axial",
+            layout="single",
             z=0,
         )
+        pool = render.tile_pool()
         self_request = False
         self_action = lambda b, s: s + (1 - 0) * b * (s == 0)
+        self_brush = ("circle", 5, 1.0)
+        self_labels = (0, 1)
+        self_sent = None  # request time of the oldest input not drawn yet
+        edit_start = None
+
+        def touch(handle, box=None):
+            """Account for a change of `box` (all of the segmentation by default) in the slabs and the levels."""
+            if box is None:
+                levels.pop(handle, None)
+                building.pop(handle, None)
+                box = (slice(None),) * 3
+            box = tuple(slice(*s.indices(size)[:2]) for s, size in zip(box, segms[handle].shape))
+            dirty[handle].update(range(
+                box[2].start // nibabel_utils.PATCH_SLAB, (box[2].stop - 1) // nibabel_utils.PATCH_SLAB + 1))
+            for factor, level in levels.get(handle, {}).items():
+                x, y = (slice(s.start - s.start % factor, min(size, -(-s.stop // factor) * factor))
+                        for s, size in zip(box[:2], segms[handle].shape))
+                level[x.start // factor:-(-x.stop // factor), y.start // factor:-(-y.stop // factor), box[2]] = \
+                    render.pool(segms[handle].read((x, y, box[2])), factor, "max")
+
+        def build_levels(handle):
+            """Build the next slab of the levels of `handle`: one slab per idle loop, so edits are not held up.
+
+            Pooling is in x and y only, so slabs are independent; edits to the slabs built are kept by `touch`.
+            """
+            x, y, z = segms[handle].shape
+            if handle not in levels:
+                levels[handle] = {
+                    factor: np.zeros((-(-x // factor), -(-y // factor), z), dtype=np.uint8)
+                    for factor in render.LOD_FACTORS
+                }
+                building[handle] = 0
+            start = building[handle]
+            stop = min(z, start + nibabel_utils.PATCH_SLAB)
+            sub = segms[handle].read((slice(None), slice(None), slice(start, stop)))
+            for factor, level in levels[handle].items():
+                level[..., start:stop] = render.pool(sub, factor, "max")
+            if stop < z:
+                building[handle] = stop
+            else:
+                del building[handle]
+
+        def tracked(handle, box, edit):
+            """Run `edit` on a dense copy of `segms[handle][box]` and store it back, updating the label stats."""
+            sub = segms[handle].read(box)
+            before = label_stats.histogram(sub) if handle in stats else None
+            edit(sub)
+            segms[handle].write(box, sub)
+            touch(handle, box)
+            if before is None:
+                recount.add(handle)
+            else:
+                stats[handle].update(box, before, label_stats.histogram(sub))
+                updated.add(handle)
+
+        def report():
+            for handle in recount & set(segms):
+                stats[handle] = label_stats.LabelStats(segms[handle])
+            if self.stats_queue is not None:
+                for handle in (recount | updated) & set(segms):
+                    self.stats_queue.put(SimpleNamespace(handle=handle, occupancy=stats[handle].occupancy))
+            recount.clear()
+            updated.clear()
+
+        def locate(request):
+            """Index in the plane view of the slice pixel under the click of `request`."""
+            event = request.event
+            shape = render.plane_shape(segms[request.handle].shape, request.plane)
+            x, y = render.canvas_to_slice(event.x, event.y, event.canvas_size, max(shape), request.box)
+            return render.unorient(y, x, shape, request.swap_xy, request.flip_x, request.flip_y)
+
+        def edit_done():
+            nonlocal edit_start
+            if edit_start is not None:
+                self.timings.record(
+                    "over.edit", edit_start, time.perf_counter() - edit_start, timing.depth(self.edit_queue))
+                edit_start = None
 
         def put():
-            try:
-                slice = np.uint8(segm[:, :, draw_parameters.z])
-            except:
-                slice = np.random.randint(0, 3, (512, 512)).astype(np.uint8)
-            if draw_parameters.swap_xy:
-                slice = slice.transpose()
-            if draw_parameters.flip_x:
-                slice = np.flip(slice, axis=0)
-            if draw_parameters.flip_y:
-                slice = np.flip(slice, axis=1)
-
-            red = 255 * np.uint8(slice == 1)
-            green = 255 * np.uint8(slice == 2)
-            blue = 255 * np.uint8(slice == 0)
-            alpha = np.uint8(np.zeros_like(slice) + 255 * 0.6 * (slice > 0))
-
-            img = Image.fromarray(
-                np.stack([red, green, blue, alpha], axis=-1)
-            ).convert('RGBA').resize((draw_parameters.resolution, draw_parameters.resolution))
+            with self.timings.stage("over.slice"):
+                request_box = draw_parameters.box
+                try:
+                    handle = draw_parameters.handle
+                    if getattr(draw_parameters, "lod", False) and handle in levels and handle not in building:
+                        factor = max(levels[handle])
+                        index, factors = render.level_view(
+                            draw_parameters.plane, draw_parameters.z, factor, draw_parameters.swap_xy)
+                        slice = render.plane(levels[handle][factor], draw_parameters.plane, index)
+                        request_box = render.scale_box(request_box, factors)
+                    else:
+                        slice = segms[handle].plane(draw_parameters.plane, draw_parameters.z)
+                except:
+                    slice = np.random.randint(0, 3, (512, 512)).astype(np.uint8)
+                slice = render.orient(slice, draw_parameters.swap_xy, draw_parameters.flip_x, draw_parameters.flip_y)
+                slice, box = render.crop(slice, request_box)
+
+            with self.timings.stage("over.colorize"):
+                img = Image.fromarray(render.colorize(slice)).convert('RGBA')
+            tile_pool = pool if draw_parameters.tiled else None
+            with self.timings.stage("over.resize"):
+                if draw_parameters.layout in render.GRID_LAYOUTS:
+                    img = render.compose(
+                        [img], draw_parameters.layout, draw_parameters.resolution, draw_parameters.resample,
+                        tile_pool, box)
+                else:
+                    img = render.resize(img, draw_parameters.resolution, draw_parameters.resample, tile_pool, box)
+            img.info["sent"] = self_sent
             self.return_queue.put(img)
 
         while self.is_alive:
+            edit_done()
             try:
                 edit_request = self.edit_queue.get_nowait()
+                edit_start = time.perf_counter()
+                if self_sent is None:
+                    self_sent = getattr(edit_request, "sent", None)
             except queue.Empty:
                 edit_request = None
-            if hasattr(edit_request, 'event'):
-                event = edit_request.event
-
-                scan_size = edit_request.scan_size
-                swap_xy = edit_request.swap_xy
-                flip_x = edit_request.flip_x
-                flip_y = edit_request.flip_y
-                action = self_action
-                brush = edit_request.brush
-                r = edit_request.r
-                z = edit_request.z
-                canvas_size = event.canvas_size
-                n = max(*canvas_size) / scan_size
-                x, y = int(event.x / n), int(event.y / n)
-                if not swap_xy:
-                    x, y = y, x
-                if not flip_x:
-                    x = (scan_size - 1) - x
-                if not flip_y:
-                    y = (scan_size - 1) - y
-                xa, xb, xo, ya, yb, yo = max(0, x - r - 1), min(x + r, scan_size), abs(min(0, x - r - 1)), max(0,
-                                                                                                            y - r - 1), min(
-                    y + r, scan_size), abs(min(0, y - r - 1))
-
-                segm[xa:xb, ya:yb, z] = action(brush[xo:xo + xb - xa, yo:yo + yb - ya], segm[xa:xb, ya:yb, z])
+            if hasattr(edit_request, "open"):
+                print("OIWorker opened", edit_request.open, edit_request.segm.shape)
+                segms[edit_request.open] = BlockLabels.from_dense(np.uint8(edit_request.segm))
+                recount.add(edit_request.open)
+                levels.pop(edit_request.open, None)
+                building.pop(edit_request.open, None)
+                dirty[edit_request.open] = set()
+                if getattr(edit_request, "dirty", ()) is None:
+                    touch(edit_request.open)
+                else:
+                    dirty[edit_request.open].update(getattr(edit_request, "dirty", ()))
+                if getattr(edit_request, "scan", None) is not None:
+                    scans[edit_request.open] = edit_request.scan
+                self_request = True
+                continue
+            elif hasattr(edit_request, "close"):
+                segm = segms.pop(edit_request.close, None)
+                stats.pop(edit_request.close, None)
+                dirty.pop(edit_request.close, None)
+                levels.pop(edit_request.close, None)
+                building.pop(edit_request.close, None)
+                if edit_request.close in scans:
+                    scans.pop(edit_request.close).close()
+                if edit_request.close in edited and edit_request.spill is not None:
+                    np.save(edit_request.spill, segm.dense())
+                edited.discard(edit_request.close)
+                continue
+            elif hasattr(edit_request, "handle") and edit_request.handle not in segms:
+                if hasattr(edit_request, "save"):
+                    # No case open: reply all the same, the GUI waits for it.
+                    self.save_queue.put(SimpleNamespace(handle=edit_request.handle, path=None, md5=None))
+                continue
+            elif hasattr(edit_request, "handle"):
+                edited.add(edit_request.handle)
+            if hasattr(edit_request, 'event') and hasattr(edit_request, "fill"):
+                if edit_request.handle not in scans:
+                    continue
+                row, col = locate(edit_request)
+                seed = [row, col]
+                seed.insert(render.PLANE_AXES[edit_request.plane], edit_request.z)
+                scan = scans[edit_request.handle].as_numpy[edit_request.phase]
+                box, region = regions.grow(scan, tuple(seed), edit_request.fill, edit_request.extent)
+
+                def fill(sub):
+                    sub[...] = self_action(region, sub)
+                tracked(edit_request.handle, box, fill)
+                self_request = True
+                continue
+            elif hasattr(edit_request, 'event'):
+                row, col = locate(edit_request)
+                box = brush.bounds(
+                    segms[edit_request.handle].shape, edit_request.plane, edit_request.z, row, col, self_brush)
+                origin = [s.start for s in box]
+                z = edit_request.z - origin.pop(render.PLANE_AXES[edit_request.plane])
+                tracked(edit_request.handle, box, lambda sub: brush.stroke(
+                    sub, edit_request.plane, z, row - origin[0], col - origin[1], self_brush, self_action))
+                self_request = True
+                continue
+            elif hasattr(edit_request, "propagate"):
+                if edit_request.handle not in scans:
+                    continue
+                box = [slice(None)] * 3
+                z, steps = edit_request.z, edit_request.propagate
+                start = max(0, min(z, z + steps))
+                box[render.PLANE_AXES[edit_request.plane]] = slice(start, max(z, z + steps) + 1)
+                box = tuple(box)
+                scan = scans[edit_request.handle].as_numpy[edit_request.phase][box]
+                # A delete action follows the label it deletes: the background would spread anywhere.
+                seed = self_labels[0] if self_labels[1] == 0 else None
+                tracked(edit_request.handle, box, lambda sub: regions.propagate(
+                    sub, scan, edit_request.plane, z - start, self_labels[1], steps, edit_request.tolerance,
+                    over=self_labels[0], seed=seed))
                 self_request = True
                 continue
             elif hasattr(edit_request, "flipaxis"):
-                segm = np.flip(segm, axis=edit_request.flipaxis)
+                segms[edit_request.handle] = BlockLabels.from_dense(
+                    flip(segms[edit_request.handle].dense(), edit_request.flipaxis))
+                recount.add(edit_request.handle)
+                touch(edit_request.handle)
                 self_request = True
                 continue
             elif hasattr(edit_request, "translate"):
-                back = np.zeros_like(segm)
-                delta = edit_request.translate
-                if delta > 0:
-                    back[..., delta:] = segm[..., :-delta]
-                else:
-                    back[..., :delta] = segm[..., -delta:]
-                segm = back
+                segms[edit_request.handle] = BlockLabels.from_dense(
+                    translate(segms[edit_request.handle].dense(), edit_request.translate))
+                recount.add(edit_request.handle)
+                touch(edit_request.handle)
                 self_request = True
                 continue
             elif hasattr(edit_request, "set_action"):
@@ -130,28 +306,74 @@ class Worker:
                 from_index, to_index = action // 10, action % 10
                 self_action = lambda b, s: s + \
                     (to_index - from_index) * b * (s == from_index)
+                self_labels = (from_index, to_index)
+            elif hasattr(edit_request, "set_brush"):
+                self_brush = edit_request.set_brush
+                brush.kernel(*self_brush)
             elif hasattr(edit_request, "mask"):
-                shape = edit_request.shape
-                mask = np.zeros(shape)
-                ed_mask = np.clip(edit_request.mask, 0, 1)
-                top = min(ed_mask.shape[-1], mask.shape[-1])
-                mask[..., :top] = ed_mask[..., :top]
-                segm = mask * edit_request.index + (1-mask) * segm
+                segms[edit_request.handle] = BlockLabels.from_dense(
+                    merge_mask(segms[edit_request.handle].dense(), edit_request.mask, edit_request.index))
+                recount.add(edit_request.handle)
+                touch(edit_request.handle)
+                self_request = True
+                continue
+            elif hasattr(edit_request, "replace"):
+                segms[edit_request.handle] = BlockLabels.from_dense(np.uint8(edit_request.replace))
+                recount.add(edit_request.handle)
+                touch(edit_request.handle)
+                self_request = True
+                continue
+            elif hasattr(edit_request, "clear"):
+                segms[edit_request.handle] = BlockLabels(segms[edit_request.handle].shape)
+                recount.add(edit_request.handle)
+                touch(edit_request.handle)
                 self_request = True
                 continue
             elif hasattr(edit_request, "save"):
-                self.save_queue.put(segm)
+                try:
+                    segm = segms[edit_request.handle]
+                    slabs = dirty[edit_request.handle]
+                    read = lambda start, stop: segm.read((slice(None), slice(None), slice(start, stop)))
+                    # A delta save writes only the slabs changed since the last whole save, as a patch
+                    # of the segmentation.nii.gz there, unless most of the volume changed.
+                    base = edit_request.save / "segmentation.nii.gz"
+                    if getattr(edit_request, "delta", False) and base.exists() \
+                            and 2 * len(slabs) * nibabel_utils.PATCH_SLAB <= segm.shape[2]:
+                        path, md5 = nibabel_utils.write_patch(read, slabs, edit_request.save) if slabs else (None, None)
+                    else:
+                        path, md5 = nibabel_utils.stream_segmentation(read, segm.shape, edit_request.save)
+                        nibabel_utils.patch_path(edit_request.save).unlink(missing_ok=True)
+                        slabs.clear()
+                    edited.discard(edit_request.handle)
+                    self.save_queue.put(SimpleNamespace(handle=edit_request.handle, path=path, md5=md5))
+                except Exception as err:
+                    print("Saving failed.", err)
+                    self.save_queue.put(SimpleNamespace(handle=edit_request.handle, path=None, md5=None))
+            edit_done()
             while True:
                 try:
                     draw_parameters = self.draw_queue.get_nowait()
                     self_request = True
                 except queue.Empty:
                     break
+                sent = getattr(draw_parameters, "sent", None)
+                if sent is not None:
+                    self.timings.record(
+                        "over.queue", sent, time.perf_counter() - sent, timing.depth(self.draw_queue))
+                    self_sent = sent if self_sent is None else self_sent
+            for handle in set(levels) - {draw_parameters.handle}:
+                # Only the segmentation on screen keeps its levels: the others would cost memory for nothing.
+                levels.pop(handle)
+                building.pop(handle, None)
             if self_request:
+                report()
                 put()
                 self_request = False
+                self_sent = None
+            elif draw_parameters.handle in set(segms) - (set(levels) - set(building)):
+                build_levels(draw_parameters.handle)
             else:
-                time.sleep(0.5)
+                time.sleep(0.01)
     
     def stop(self):
         self.is_alive = False
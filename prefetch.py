@@ -0,0 +1,160 @@
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+from . import nibabel_utils as nu
+from . import pydrive_utils as pu
+
+
+class Prefetcher:
+    """Downloads and decodes upcoming cases into `cache_path` from a background thread.
+
+    Each case lives in `cache_path / case`, with a `.ready` marker once all its files are there.
+    With `source=None` the cases are already local (debug mode), so they are only decoded and
+    never evicted.
+    """
+
+    def __init__(
+            self,
+            cache_path: Path,
+            source: Optional[pu.DrivePath] = None,
+            depth: int = 2,
+            disk_budget: int = 8 * 2 ** 30,
+            bandwidth: Optional[float] = None,
+    ):
+        self.cache_path = cache_path
+        self.source = source
+        self.depth = depth
+        self.disk_budget = disk_budget
+        self.bandwidth = bandwidth  # bytes per second, None for unlimited
+
+        self._lock = threading.Lock()
+        self._case_locks = {}
+        self._pending = []
+        self._keep = set()
+        self._cancel = threading.Event()
+        self._wake = threading.Event()
+        self._is_alive = True
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+
+    def schedule(self, cases: Iterable, keep: Iterable = ()):
+        """Cancel the running prefetch and start over with `cases`, never evicting `keep`."""
+        with self._lock:
+            self._pending = [str(case) for case in cases]
+            self._keep = set(self._pending) | {str(case) for case in keep}
+            self._cancel.set()
+        self._wake.set()
+
+    def stop(self):
+        self._is_alive = False
+        self._cancel.set()
+        self._wake.set()
+        self._thread.join(timeout=2)
+
+    def case_path(self, case) -> Path:
+        return self.cache_path / str(case)
+
+    def is_ready(self, case) -> bool:
+        return (self.case_path(case) / ".ready").exists()
+
+    def case_lock(self, case) -> threading.Lock:
+        with self._lock:
+            return self._case_locks.setdefault(str(case), threading.Lock())
+
+    def fetch(
+            self,
+            case,
+            progress: Callable[[int, int], None] = None,
+            cancel: threading.Event = None,
+            decode: bool = True,
+    ) -> bool:
+        """Download (and decode) `case` into the cache. Returns True if the case is ready.
+
+        Without `cancel` this is a foreground fetch: no bandwidth throttling and no disk budget.
+        """
+        case_path = self.case_path(case)
+        with self.case_lock(case):
+            if self.is_ready(case):
+                (case_path / ".ready").touch()
+                return True
+            case_path.mkdir(parents=True, exist_ok=True)
+            if self.source is not None:
+                files = [file for file in (self.source / str(case)).iterdir()
+                         if not (case_path / file.name).exists()]
+                size = sum(int(file.obj.get("fileSize", 0)) for file in files)
+                if cancel is not None and not self.make_room(size):
+                    print(f"Prefetch of {case} skipped: disk budget exceeded.")
+                    return False
+                for i, file in enumerate(files):
+                    if cancel is not None and cancel.is_set():
+                        return False
+                    if progress:
+                        progress(i, len(files))
+                    target = case_path / file.name
+                    partial = target.with_name(target.name + ".part")
+                    start = time.perf_counter()
+                    file.obj.GetContentFile(str(partial))
+                    partial.replace(target)
+                    self.throttle(target.stat().st_size, time.perf_counter() - start, cancel)
+            if cancel is not None and cancel.is_set():
+                return False
+            if decode:
+                nu.decode(case_path)
+            (case_path / ".ready").touch()
+        if cancel is not None:
+            self.make_room(0)
+        return True
+
+    def throttle(self, size: int, elapsed: float, cancel: Optional[threading.Event]):
+        if self.bandwidth and cancel is not None:
+            delay = size / self.bandwidth - elapsed
+            if delay > 0:
+                cancel.wait(delay)
+
+    def usage(self) -> int:
+        return sum(path.stat().st_size for path in self.cache_path.rglob("*") if path.is_file())
+
+    def make_room(self, size: int) -> bool:
+        """Evict least recently used cases not in the keep set until `size` more bytes fit.
+
+        Cases with unsaved edits spilled to edited_segmentation.npy stay until a save makes the spill stale.
+        """
+        if self.source is None:
+            return True
+        usage = self.usage()
+        ready = sorted(
+            (marker.parent for marker in self.cache_path.rglob(".ready")),
+            key=lambda case_path: (case_path / ".ready").stat().st_mtime,
+        )
+        for case_path in ready:
+            if usage + size <= self.disk_budget:
+                break
+            case = str(case_path.relative_to(self.cache_path))
+            with self._lock:
+                if case in self._keep:
+                    continue
+            if nu.is_fresh(nu.edited_path(case_path), case_path / "segmentation.nii.gz"):
+                continue  # Unsaved edits of an evicted case, spilled here: never delete them.
+            with self.case_lock(case):
+                freed = sum(path.stat().st_size for path in case_path.rglob("*") if path.is_file())
+                shutil.rmtree(case_path, ignore_errors=True)
+            usage -= freed
+        return usage + size <= self.disk_budget
+
+    def run(self):
+        while self._is_alive:
+            self._wake.wait()
+            with self._lock:
+                self._wake.clear()
+                self._cancel.clear()
+                pending = list(self._pending)
+            for case in pending:
+                if self._cancel.is_set():
+                    break
+                try:
+                    self.fetch(case, cancel=self._cancel)
+                except Exception as err:
+                    print(f"Prefetch of {case} failed.", err)
@@ -0,0 +1,20 @@
+import functools
+import multiprocessing
+
+# Imported once by the fork server: every worker then starts as a fork of an interpreter that has them.
+PRELOAD = ["numpy", "PIL.Image", f"{__package__}.base_draw_process", f"{__package__}.over_draw_process"]
+
+
+@functools.lru_cache(maxsize=None)
+def context():
+    """The multiprocessing context of the workers and of everything they share (queues, values, arrays).
+
+    Where there is a fork server (Linux, macOS) it is one with PRELOAD imported: starting a worker costs a
+    fork of that small, single threaded process, instead of a fork of Tk and its threads or a spawn that
+    imports numpy and PIL again. Elsewhere (Windows) it is the default spawn context.
+    """
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context()
+    ctx = multiprocessing.get_context("forkserver")
+    ctx.set_forkserver_preload(PRELOAD)
+    return ctx
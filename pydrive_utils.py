@@ -1,33 +1,259 @@
 import functools
+import hashlib
 import random
+import re
+import shutil
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from dataclasses import dataclass, field
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Callable, Union, Iterator, List
+from typing import TYPE_CHECKING, Callable, Union, Iterator, List, Optional
 
-from pydrive.auth import GoogleAuth
-from pydrive.drive import GoogleDrive
-from pydrive.files import GoogleDriveFile
+if TYPE_CHECKING:
+    from pydrive.files import GoogleDriveFile
 
 PathLike = Union[str, List[str], "AbstractPath", "DrivePath", "Path"]
 drive = ...
 
 
+FOLDER = "application/vnd.google-apps.folder"
+
+
+def modified_date(timestamp: float) -> str:
+    """RFC 3339 time, as Drive gives modifiedDate."""
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+class MockError(IOError):
+    """Raised by MockDrive where pydrive raises ApiRequestError: missing files, bad queries, injected failures."""
+
+
+class MockFile(dict):
+    """A GoogleDriveFile look-alike for MockDrive: the metadata is the dict itself."""
+
+    def __init__(self, drive: "MockDrive", metadata: dict):
+        super().__init__(metadata)
+        self.drive = drive
+        self.content_file = None
+
+    @property
+    def metadata(self) -> dict:
+        return self
+
+    def GetContentFile(self, filename: str):
+        self.drive.transfer("download", self["id"], self.drive.path(self["id"]), Path(filename))
+
+    def SetContentFile(self, filename: str):
+        self.content_file = filename
+
+    def Upload(self):
+        if "id" in self:
+            target = self.drive.path(self["id"])
+        else:
+            target = self.drive.path(self["parents"][0]["id"]) / self["title"]
+        if self.get("mimeType") == FOLDER:
+            self.drive.call("insert", self.drive.id_of(target))
+            target.mkdir(parents=True, exist_ok=True)
+        elif self.content_file is not None:
+            # A failed upload leaves the file as it was, as on Drive.
+            partial = target.with_name(target.name + MockDrive.uploading)
+            try:
+                self.drive.transfer("upload", self.drive.id_of(target), Path(self.content_file), partial)
+            except MockError:
+                partial.unlink(missing_ok=True)
+                raise
+            partial.replace(target)
+        else:
+            self.drive.call("update", self.drive.id_of(target))
+        self.update(self.drive.metadata(target))
+
+    def Delete(self):
+        self.drive.call("delete", self["id"])
+        path = self.drive.path(self["id"])
+        if path.is_dir():
+            shutil.rmtree(path)
+        else:
+            path.unlink()
+
+
+class MockList(list):
+    def GetList(self):
+        return self
+
+
 class MockDrive:
+    """Stands in for GoogleDrive over the local folder `tmpdir`, whose folders and files it serves.
+
+    Ids are opaque, and stable across instances: a hash of the path relative to `tmpdir`. `ListFile`
+    understands the conditions of the Drive v2 query language that the app and its scripts use, joined
+    by `and`; without a parent condition it searches the whole tree, as Drive does. Metadata carries
+    fileSize, md5Checksum, modifiedDate and parents.
+
+    Every request waits `latency` seconds, and contents move at `bandwidth` bytes per second. A request
+    fails with MockError with probability `error_rate`, or `error_rate[kind]` for a dict by kind of request
+    ("list", "download", "upload", ...): a failed download leaves a partial file behind,
+    a failed upload leaves Drive as it was.
+    Whether the n-th request of a kind on an id fails depends only on `seed`, not on the order in which
+    threads get there, so concurrent runs are reproducible. `calls` counts the requests by kind.
+    """
     tmpdir = Path("/home/yamatteo/tmpdir")
-
-    def ListFile(self, *args, **kwargs):
-        return [self.CreateFile(id=0, title=file.name) for file in self.tmpdir.iterdir()]
+    block = 2 ** 20
+    uploading = ".mock-upload"
+
+    def __init__(self, tmpdir: Path = None, latency: float = 0.0, bandwidth: float = None,
+                 error_rate: Union[float, dict] = 0.0, seed: int = 0):
+        if tmpdir is not None:
+            self.tmpdir = Path(tmpdir)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.seed = seed
+        self.calls = Counter()
+        self._attempts = Counter()
+        self._lock = threading.Lock()
+        self._paths = {"root": self.tmpdir}
+        self._md5 = {}
+
+    def call(self, kind: str, file_id: str = None) -> Optional[float]:
+        """Account for a request: wait the latency, and draw whether it fails.
+
+        Returns None for a request that succeeds, else the fraction of the content moved before it fails.
+        Requests that move no content raise MockError right away instead.
+        """
+        with self._lock:
+            self.calls[kind] += 1
+            self._attempts[kind, file_id] += 1
+            attempt = self._attempts[kind, file_id]
+        if self.latency:
+            time.sleep(self.latency)
+        rate = self.error_rate.get(kind, 0) if isinstance(self.error_rate, dict) else self.error_rate
+        if rate:
+            draw = random.Random(f"{self.seed}:{kind}:{file_id}:{attempt}")
+            if draw.random() < rate:
+                if kind in ("download", "upload"):
+                    return draw.random()
+                raise MockError(f"Injected failure of {kind} {file_id} (attempt {attempt}).")
+        return None
+
+    def transfer(self, kind: str, file_id: Optional[str], source: Path, target: Path):
+        """Copy `source` to `target` by blocks, at `bandwidth`, maybe failing part way."""
+        if not source.is_file():
+            raise MockError(f"File not found: {file_id}")
+        fails_at = self.call(kind, file_id)
+        size = source.stat().st_size
+        stop = size if fails_at is None else int(size * fails_at)
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            done = 0
+            while done < stop:
+                data = src.read(min(self.block, stop - done))
+                dst.write(data)
+                done += len(data)
+                if self.bandwidth:
+                    time.sleep(len(data) / self.bandwidth)
+        if fails_at is not None:
+            raise MockError(f"Injected failure of {kind} {file_id} after {stop} of {size} bytes.")
+        with self._lock:
+            self.calls[kind + "_bytes"] += size
+
+    def id_of(self, path: Path) -> str:
+        if path == self.tmpdir:
+            return "root"
+        file_id = hashlib.sha1(path.relative_to(self.tmpdir).as_posix().encode()).hexdigest()[:28]
+        self._paths[file_id] = path
+        return file_id
+
+    def path(self, file_id: str) -> Path:
+        if file_id not in self._paths:
+            # Ids of paths never served yet, from an earlier instance say: index the whole tree.
+            for path in self.tmpdir.rglob("*"):
+                self.id_of(path)
+        if file_id not in self._paths:
+            raise MockError(f"File not found: {file_id}")
+        return self._paths[file_id]
+
+    def md5(self, path: Path, stat) -> str:
+        from .nibabel_utils import file_md5
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key not in self._md5:
+            self._md5[key] = file_md5(path)
+        return self._md5[key]
+
+    def metadata(self, path: Path) -> dict:
+        stat = path.stat()
+        metadata = dict(id=self.id_of(path), title=path.name, modifiedDate=modified_date(stat.st_mtime))
+        if path != self.tmpdir:
+            metadata["parents"] = [dict(id=self.id_of(path.parent))]
+        if path.is_dir():
+            metadata["mimeType"] = FOLDER
+        else:
+            metadata["mimeType"] = "application/octet-stream"
+            metadata["fileSize"] = str(stat.st_size)
+            metadata["md5Checksum"] = self.md5(path, stat)
+        return metadata
+
+    QUERY = {
+        "parent": re.compile(r"'([^']+)' in parents"),
+        "title": re.compile(r"title\s*=\s*'(.*)'"),
+        "contains": re.compile(r"title contains '(.*)'"),
+        "type": re.compile(r"mimeType\s*=\s*'(.*)'"),
+        "not_type": re.compile(r"mimeType\s*!=\s*'(.*)'"),
+        "trashed": re.compile(r"trashed\s*=\s*(true|false)"),
+    }
+
+    def parse(self, query: str) -> dict:
+        conditions = {}
+        for text in filter(None, (condition.strip() for condition in query.split(" and "))):
+            for kind, pattern in self.QUERY.items():
+                match = pattern.fullmatch(text)
+                if match:
+                    conditions[kind] = match[1]
+                    break
+            else:
+                raise MockError(f"Invalid query: {text!r}")
+        return conditions
+
+    @staticmethod
+    def matches(path: Path, conditions: dict) -> bool:
+        # Files are not told apart by type: any mimeType other than FOLDER stands for all of them.
+        return (
+            not path.name.endswith(MockDrive.uploading)
+            and ("title" not in conditions or path.name == conditions["title"])
+            and ("contains" not in conditions or conditions["contains"] in path.name)
+            and ("type" not in conditions or (conditions["type"] == FOLDER) == path.is_dir())
+            and ("not_type" not in conditions or (conditions["not_type"] == FOLDER) != path.is_dir())
+        )
+
+    def ListFile(self, param: dict = None):
+        conditions = self.parse((param or {}).get("q", ""))
+        self.call("list", conditions.get("parent"))
+        if conditions.get("trashed") == "true":
+            paths = []
+        elif "parent" in conditions:
+            folder = self.path(conditions["parent"])
+            paths = sorted(folder.iterdir()) if folder.is_dir() else []
+        else:
+            paths = sorted(self.tmpdir.rglob("*"))
+        return MockList(MockFile(self, self.metadata(path)) for path in paths if self.matches(path, conditions))
 
     def CreateFile(self, arg=None, **kwargs):
-        if arg is None:
-            arg = {}
-        return dict(arg, **kwargs)
+        metadata = dict(arg or {}, **kwargs)
+        if "id" in metadata:
+            path = self.path(metadata["id"])
+            if path.exists():
+                metadata = dict(self.metadata(path), **metadata)
+        return MockFile(self, metadata)
 
 
 def connect(path: Path = None, mock=False):
     global drive
     if mock:
         return
+    # pydrive pulls in the Google API client: import it only once a connection is asked for.
+    from pydrive.auth import GoogleAuth
+    from pydrive.drive import GoogleDrive
     if path is None:
         this_file = Path(__file__)
         path = this_file.parent
@@ -91,7 +317,7 @@ class AbstractPath:
 @dataclass
 class DrivePath(AbstractPath):
     root: str = "root"
-    obj: GoogleDriveFile = field(default_factory=dict)
+    obj: "GoogleDriveFile" = field(default_factory=dict)
 
     def __eq__(self, other):
         if isinstance(other, DrivePath):
@@ -250,6 +476,40 @@ def discover(path: DrivePath, select_dir: Callable = is_anything) -> list[DriveP
     # return selected_paths
 
 
+def walk(path: DrivePath, select_names: Callable[[set], bool], threads: int = 8,
+         prune: bool = True) -> Iterator[tuple[DrivePath, list]]:
+    """Like `discover`, but each folder is listed once and `threads` listings run at once.
+
+    The criteria of `discover` list a folder for every check; here the listing is judged by the names
+    it holds with `select_names`. Yields each selected folder with the metadata of its items, as they
+    come: the order is not deterministic. Selected folders are explored too, unless `prune`.
+    """
+    def listing(folder: DrivePath) -> tuple[DrivePath, list]:
+        # Subfolders carry their listed metadata: their id is known without resolving the path again.
+        return folder, list_items(parent_id=folder.obj.get("id") or folder.id)
+
+    with ThreadPoolExecutor(threads) as pool:
+        pending = {pool.submit(listing, path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                folder, items = future.result()
+                if select_names({item["title"] for item in items}):
+                    yield folder, items
+                    if prune:
+                        continue
+                pending.update(
+                    pool.submit(listing, DrivePath(folder.parts + [item["title"]], root=folder.root, obj=item))
+                    for item in items if item.get("mimeType") == FOLDER
+                )
+
+
+def has_trainable(names: set) -> bool:
+    """`is_trainable` on the names of a listing."""
+    return all(name in names for name in [f"registered_phase_{phase}.nii.gz" for phase in ["b", "a", "v", "t"]]
+               + ["segmentation.nii.gz"])
+
+
 # Iterators
 def iter_containing(path: DrivePath, filelist: list) -> Iterator[DrivePath]:
     """Iterates over subfolders containing listed files."""
@@ -278,7 +538,7 @@ def iter_trainable(path: DrivePath) -> Iterator[DrivePath]:
 
 def split_trainables(path: DrivePath, n: int = 10, shuffle=False, offset=0) -> tuple[list[DrivePath], list[DrivePath]]:
     """Lists of case_path for train and valid dataset."""
-    trainables = list(iter_trainable(path))
+    trainables = sorted((case for case, _ in walk(path, has_trainable)), key=lambda case: case.parts)
     if offset:
         trainables = [*trainables[offset:], *trainables[:offset]]
     train_cases = list(path / case for k, case in enumerate(trainables) if k % n != 0)
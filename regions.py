@@ -0,0 +1,56 @@
+import numpy as np
+
+from . import render
+
+
+def bounds(shape: tuple, center: tuple, extent: int) -> tuple:
+    """Slices of the box of half side `extent` around `center`, clipped to `shape`."""
+    return tuple(slice(max(0, c - extent), min(size, c + extent + 1)) for c, size in zip(center, shape))
+
+
+def grow(scan: np.ndarray, seed: tuple, tolerance: float, extent: int = 64) -> tuple:
+    """Region of `scan` connected to `seed` whose intensity is within `tolerance` of the seed's.
+
+    Only the box of half side `extent` around the seed is labelled. Returns the box and the region mask in it.
+    """
+    from scipy import ndimage
+    box = bounds(scan.shape, seed, extent)
+    sub = scan[box].astype(np.float32)
+    local_seed = tuple(c - s.start for c, s in zip(seed, box))
+    labels, _ = ndimage.label(np.abs(sub - sub[local_seed]) <= tolerance)
+    return box, labels == labels[local_seed]
+
+
+def propagate(segm: np.ndarray, scan: np.ndarray, plane: str, index: int, label: int, steps: int,
+              tolerance: float, over: int = 0, extent: int = 16, seed: int = None) -> range:
+    """Extend the `label` region of plane `index` over the next `steps` planes (backwards if negative).
+
+    On each plane the candidates are the pixels within `tolerance` of the mean intensity of the region
+    on the previous plane, and the connected candidates that overlap it are labelled where they were
+    `over`. Only the bounding box of the region grown by `extent` is labelled. Stops when the region
+    vanishes. Returns the range of planes that were changed.
+
+    With `seed`, the region followed is the `seed` one of plane `index` instead, and it is set to `label`
+    on the next planes: with seed and over the same label and label 0, it is erased plane by plane.
+    """
+    from scipy import ndimage
+    step = 1 if steps > 0 else -1
+    depth = segm.shape[render.PLANE_AXES[plane] - 3]
+    region = render.plane(segm, plane, index) == (label if seed is None else seed)
+    last = index
+    for target in range(index + step, min(max(index + steps + step, -1), depth), step):
+        if not region.any():
+            break
+        rows, cols = np.nonzero(region)
+        box = (slice(max(0, rows.min() - extent), rows.max() + extent + 1),
+               slice(max(0, cols.min() - extent), cols.max() + extent + 1))
+        mean = render.plane(scan, plane, last)[region].mean()
+        intensity = render.plane(scan, plane, target)[box].astype(np.float32)
+        labels, _ = ndimage.label(np.abs(intensity - mean) <= tolerance)
+        overlap = np.unique(labels[region[box] & (labels > 0)])
+        region = np.zeros_like(region)
+        region[box] = np.isin(labels, overlap) & (labels > 0)
+        view = render.plane(segm, plane, target)
+        view[region & (view == over)] = label
+        last = target
+    return range(min(index, last), max(index, last) + 1)
@@ -0,0 +1,282 @@
+import functools
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+RESAMPLING = {
+    "nearest": Image.NEAREST,
+    "bilinear": Image.BILINEAR,
+    "bicubic": Image.BICUBIC,
+    "lanczos": Image.LANCZOS,
+}
+
+# (level, width) of the intensity window. Default matches the old fixed clip to (0, 255).
+WINDOW_PRESETS = {
+    "Default": (127.5, 255),
+    "Liver": (60, 150),
+    "Vessels": (180, 600),
+}
+
+
+@functools.lru_cache(maxsize=16)
+def window_lut(level: float, width: float) -> np.ndarray:
+    """uint8 grey level of every int16 value, indexed by the value read as uint16."""
+    values = np.arange(2 ** 16, dtype=np.uint16).view(np.int16).astype(np.float32)
+    return np.uint8(np.clip((values - (level - width / 2)) / max(width, 1) * 255, 0, 255))
+
+
+def apply_window(slice: np.ndarray, window: tuple) -> np.ndarray:
+    if slice.dtype != np.int16:
+        slice = slice.astype(np.int16)
+    return window_lut(*window)[slice.view(np.uint16)]
+
+
+def apply_windows(stack: np.ndarray, windows: list) -> np.ndarray:
+    """Window each slice of `stack` with its own window, in a single gather."""
+    if stack.dtype != np.int16:
+        stack = stack.astype(np.int16)
+    luts = np.stack([window_lut(*window) for window in windows])
+    return luts[np.arange(len(windows))[:, None, None], stack.view(np.uint16)]
+
+
+# Phases shown side by side, as (phase, row, column) with the canvas split in 2x2 cells.
+GRID_LAYOUTS = {
+    "pair": ((1, 0.5, 0), (2, 0.5, 1)),
+    "quad": ((0, 0, 0), (1, 0, 1), (2, 1, 0), (3, 1, 1)),
+}
+# Phases blended in one image.
+BLEND_LAYOUTS = {
+    "mix": (1, 2),
+    "fusion": (1, 2),
+}
+
+
+def layout_phases(layout: str, phase: int) -> list:
+    if layout in GRID_LAYOUTS:
+        return [cell[0] for cell in GRID_LAYOUTS[layout]]
+    if layout in BLEND_LAYOUTS:
+        return list(BLEND_LAYOUTS[layout])
+    return [phase]
+
+
+def blend(stack: np.ndarray, layout: str) -> np.ndarray:
+    """RGB blend of two windowed slices: grey average, or the first in magenta and the second in green."""
+    if layout == "mix":
+        grey = np.uint8((stack[0].astype(np.uint16) + stack[1]) // 2)
+        return np.stack([grey, grey, grey], axis=-1)
+    return np.stack([stack[0], stack[1], stack[0]], axis=-1)
+
+
+# Which of the (x, y, z) volume axes is fixed in each plane.
+PLANE_AXES = {
+    "axial": 2,
+    "coronal": 1,
+    "sagittal": 0,
+}
+
+
+def plane(volume: np.ndarray, plane: str, index: int) -> np.ndarray:
+    """View of a plane of `volume`, whose last three axes are (x, y, z)."""
+    key = [slice(None)] * volume.ndim
+    key[volume.ndim - 3 + PLANE_AXES[plane]] = index
+    return volume[tuple(key)]
+
+
+def plane_shape(shape: tuple, plane: str) -> tuple:
+    """Shape of a plane of a volume of (x, y, z) `shape`."""
+    return tuple(size for axis, size in enumerate(shape[-3:]) if axis != PLANE_AXES[plane])
+
+
+# Pooling factors of the coarse levels of detail. Only x and y are pooled, so every axial plane is kept.
+LOD_FACTORS = (2, 4)
+
+
+def pool(volume: np.ndarray, factor: int, reduce: str = "mean") -> np.ndarray:
+    """`volume` (..., x, y, z) reduced over blocks of `factor` x `factor` in x and y: by mean for scans,
+    by max for labels, so that thin structures survive. Edges are padded by repetition to whole blocks."""
+    *lead, x, y, z = volume.shape
+    if x % factor or y % factor:
+        volume = np.pad(volume, [(0, 0)] * len(lead) + [(0, -x % factor), (0, -y % factor), (0, 0)], mode="edge")
+    blocks = volume.reshape(*lead, volume.shape[-3] // factor, factor, volume.shape[-2] // factor, factor, z)
+    if reduce == "max":
+        return blocks.max(axis=(-4, -2))
+    return blocks.mean(axis=(-4, -2), dtype=np.float32).astype(volume.dtype)
+
+
+def level_view(plane: str, index: int, factor: int, swap_xy: bool) -> tuple:
+    """Index of the plane in a level pooled by `factor`, and the (rows, columns) factors of its oriented slices."""
+    axis = PLANE_AXES[plane]
+    factors = tuple(factor if other < 2 else 1 for other in range(3) if other != axis)
+    return index // factor if axis < 2 else index, factors[::-1] if swap_xy else factors
+
+
+def scale_box(box: tuple, factors: tuple):
+    """`box` (left, upper, right, lower) of a full resolution slice, in a slice pooled by (rows, columns) `factors`."""
+    if box is None:
+        return None
+    rows, cols = factors
+    left, upper, right, lower = box
+    return left / cols, upper / rows, right / cols, lower / rows
+
+
+class PlaneCache:
+    """Contiguous copies of slabs of consecutive planes, least recently used out of `capacity` bytes.
+
+    In the (phase, x, y, z) layout no plane is contiguous: axial planes are the worst, one element per
+    cache line. Copying a slab of `slab` planes at once reads runs of `slab` neighbours instead, and
+    scrolling through the slab then reads contiguous memory.
+    """
+
+    def __init__(self, slab: int = 16, capacity: int = 512 * 2 ** 20):
+        self.slab = slab
+        self.capacity = capacity
+        self.slabs = OrderedDict()
+        self.nbytes = 0
+
+    def plane(self, handle, volume: np.ndarray, phase: int, plane: str, index: int) -> np.ndarray:
+        start = index - index % self.slab
+        key = (handle, phase, plane, start)
+        if key not in self.slabs:
+            axis = PLANE_AXES[plane]
+            slab = volume[phase].take(range(start, min(start + self.slab, volume.shape[1 + axis])), axis=axis)
+            self.slabs[key] = np.ascontiguousarray(np.moveaxis(slab, axis, 0))
+            self.nbytes += self.slabs[key].nbytes
+            while self.nbytes > self.capacity and len(self.slabs) > 1:
+                self.nbytes -= self.slabs.popitem(last=False)[1].nbytes
+        self.slabs.move_to_end(key)
+        return self.slabs[key][index - start]
+
+    def forget(self, handle):
+        """Drop the slabs of `handle`, and of its levels of detail, cached as (handle, factor)."""
+        for key in [key for key in self.slabs if (key[0][0] if isinstance(key[0], tuple) else key[0]) == handle]:
+            self.nbytes -= self.slabs.pop(key).nbytes
+
+
+def orient(slice: np.ndarray, swap_xy: bool, flip_x: bool, flip_y: bool) -> np.ndarray:
+    """Display orientation of the last two axes, so that a stack of slices is oriented at once."""
+    if swap_xy:
+        slice = slice.swapaxes(-1, -2)
+    if flip_x:
+        slice = np.flip(slice, axis=-2)
+    if flip_y:
+        slice = np.flip(slice, axis=-1)
+    return slice
+
+
+def colorize(slice: np.ndarray) -> np.ndarray:
+    """RGBA rendering of a label slice: liver in red, tumor in green, background transparent."""
+    red = 255 * np.uint8(slice == 1)
+    green = 255 * np.uint8(slice == 2)
+    blue = 255 * np.uint8(slice == 0)
+    alpha = np.uint8(np.zeros_like(slice) + 255 * 0.6 * (slice > 0))
+    return np.stack([red, green, blue, alpha], axis=-1)
+
+
+def tile_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+
+
+def crop(slice: np.ndarray, box: tuple, margin: int = 4) -> tuple:
+    """Cut `slice` to `box` (left, upper, right, lower) plus a margin for the filter support.
+
+    Returns the cut and the box in its coordinates, so that resampling the cut gives the same pixels.
+    """
+    if box is None:
+        return slice, None
+    left, upper, right, lower = box
+    x0, y0 = max(0, int(left) - margin), max(0, int(upper) - margin)
+    x1 = min(slice.shape[-1], int(np.ceil(right)) + margin)
+    y1 = min(slice.shape[-2], int(np.ceil(lower)) + margin)
+    return slice[..., y0:y1, x0:x1], (left - x0, upper - y0, right - x0, lower - y0)
+
+
+def unorient(row: int, col: int, shape: tuple, swap_xy: bool, flip_x: bool, flip_y: bool) -> tuple:
+    """Index in the plane of `shape` shown at (row, col) after `orient`."""
+    rows, cols = shape[::-1] if swap_xy else shape
+    if flip_y:
+        col = (cols - 1) - col
+    if flip_x:
+        row = (rows - 1) - row
+    if swap_xy:
+        row, col = col, row
+    return row, col
+
+
+def canvas_to_cell(x: int, y: int, resolution: int, layout: str):
+    """Canvas point (x, y) as it would be in a single view, or None if it is outside all cells."""
+    if layout not in GRID_LAYOUTS:
+        return x, y
+    side = resolution / 2
+    for phase, row, col in GRID_LAYOUTS[layout]:
+        u, v = x - col * side, y - row * side
+        if 0 <= u < side and 0 <= v < side:
+            return u * 2, v * 2
+    return None
+
+
+def canvas_to_slice(x: int, y: int, canvas_size: tuple, scan_size: int, box: tuple = None) -> tuple:
+    """Pixel of the displayed slice under the canvas point (x, y), with `box` the visible part."""
+    if box is None:
+        box = (0, 0, scan_size, scan_size)
+    left, upper, right, lower = box
+    n = max(*canvas_size)
+    return int(left + x * (right - left) / n), int(upper + y * (lower - upper) / n)
+
+
+def resize(img: Image.Image, resolution: int, resample: str = "bicubic", pool: ThreadPoolExecutor = None,
+           box: tuple = None, tile: int = 256) -> Image.Image:
+    """Resize the `box` region of `img` (all of it by default) to a square of side `resolution`.
+
+    With a `pool`, the output is split in tiles of side `tile` that are resampled concurrently: Pillow
+    releases the GIL while resampling, and each tile reads its source box with the full filter support,
+    so the result matches the single call up to rounding.
+    """
+    resample = RESAMPLING[resample]
+    if box is None:
+        box = (0, 0, img.width, img.height)
+    if pool is None or resolution <= tile:
+        return img.resize((resolution, resolution), resample, box=box)
+    scale_x, scale_y = (box[2] - box[0]) / resolution, (box[3] - box[1]) / resolution
+    boxes = [
+        (left, upper, min(left + tile, resolution), min(upper + tile, resolution))
+        for upper in range(0, resolution, tile)
+        for left in range(0, resolution, tile)
+    ]
+
+    def render_tile(tile_box):
+        left, upper, right, lower = tile_box
+        return img.resize(
+            (right - left, lower - upper),
+            resample,
+            box=(
+                box[0] + left * scale_x,
+                box[1] + upper * scale_y,
+                box[0] + right * scale_x,
+                box[1] + lower * scale_y,
+            ),
+        )
+
+    output = Image.new(img.mode, (resolution, resolution))
+    for tile_box, tile_img in zip(boxes, pool.map(render_tile, boxes)):
+        output.paste(tile_img, tile_box[:2])
+    return output
+
+
+def compose(imgs: list, layout: str, resolution: int, resample: str = "bicubic", pool: ThreadPoolExecutor = None,
+            box: tuple = None) -> Image.Image:
+    """One frame with each image resized into its cell of a grid layout; a single image goes in every cell."""
+    side = resolution // 2
+    cells = GRID_LAYOUTS[layout]
+    if len(imgs) == 1:
+        resized = [resize(imgs[0], side, resample, pool, box)] * len(cells)
+    elif pool is None:
+        resized = [resize(img, side, resample, None, box) for img in imgs]
+    else:
+        resized = list(pool.map(lambda img: resize(img, side, resample, None, box), imgs))
+    frame = Image.new(resized[0].mode, (resolution, resolution))
+    for (phase, row, col), img in zip(cells, resized):
+        frame.paste(img, (int(col * side), int(row * side)))
+    return frame
@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable, Optional
+
+import numpy as np
+
+from .shared_ndarray import SharedBlock
+
+
+class Session:
+    """Recently opened cases, kept resident in the workers under a memory budget.
+
+    Each case gets an integer handle: the scan goes into a SharedBlock that the workers attach
+    to, the segmentation is sent once to the overlay worker that keeps editing it. When the
+    budget is exceeded the least recently used cases are evicted through `on_evict`.
+    """
+
+    def __init__(self, memory_budget: int, on_evict: Callable[[SimpleNamespace], None]):
+        self.memory_budget = memory_budget
+        self.on_evict = on_evict
+        self.cases = OrderedDict()
+        self._next_handle = 0
+
+    def __contains__(self, case) -> bool:
+        return str(case) in self.cases
+
+    def __len__(self) -> int:
+        return len(self.cases)
+
+    @property
+    def usage(self) -> int:
+        return sum(entry.nbytes for entry in self.cases.values())
+
+    def get(self, case) -> Optional[SimpleNamespace]:
+        entry = self.cases.get(str(case))
+        if entry is not None:
+            self.cases.move_to_end(str(case))
+        return entry
+
+    def open(self, case, case_path: Path, scan: np.ndarray, segm: np.ndarray) -> SimpleNamespace:
+        if case in self:
+            self.close(case)
+        entry = SimpleNamespace(
+            handle=self._next_handle,
+            name=str(case),
+            path=case_path,
+            scan=SharedBlock.from_numpy(scan),
+            shape=tuple(scan.shape[1:]),
+            nbytes=scan.nbytes + segm.nbytes,
+            positions={},
+        )
+        self._next_handle += 1
+        self.cases[entry.name] = entry
+        self.evict(keep=entry.name)
+        return entry
+
+    def evict(self, keep: str = None):
+        for case in list(self.cases):
+            if self.usage <= self.memory_budget:
+                break
+            if case != keep:
+                self.close(case)
+
+    def close(self, case):
+        entry = self.cases.pop(str(case))
+        self.on_evict(entry)
+        entry.scan.unlink()
+
+    def clear(self):
+        for entry in self.cases.values():
+            entry.scan.unlink()
+        self.cases.clear()
@@ -1,5 +1,7 @@
 import multiprocessing as mp
+import os
 from dataclasses import dataclass
+from multiprocessing import resource_tracker, shared_memory
 
 import numpy as np
 
@@ -22,3 +24,50 @@ class SharedNdarray:
 
     def update(self, ndarray: np.ndarray):
         self.shared_array[:] = ndarray.reshape((-1,))
+
+
+_segments = {}
+
+if os.name == "posix":
+    # Workers forked before the tracker exists would start their own, and unlink our blocks when they exit.
+    resource_tracker.ensure_running()
+
+
+@dataclass
+class SharedBlock:
+    """An ndarray in named shared memory: pickling it only sends the name, and any process can attach."""
+    name: str
+    shape: tuple
+    dtype: str
+
+    @classmethod
+    def from_numpy(cls, ndarray: np.ndarray):
+        segment = shared_memory.SharedMemory(create=True, size=max(1, ndarray.nbytes))
+        _segments[segment.name] = segment
+        block = cls(segment.name, tuple(ndarray.shape), ndarray.dtype.str)
+        block.as_numpy[...] = ndarray
+        return block
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    @property
+    def as_numpy(self) -> np.ndarray:
+        segment = _segments.get(self.name)
+        if segment is None:
+            segment = _segments[self.name] = shared_memory.SharedMemory(name=self.name)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=segment.buf)
+
+    def close(self):
+        segment = _segments.pop(self.name, None)
+        if segment is not None:
+            try:
+                segment.close()
+            except BufferError:
+                pass  # Some view is still alive, the mapping goes away with it.
+
+    def unlink(self):
+        segment = _segments.get(self.name) or shared_memory.SharedMemory(name=self.name)
+        self.close()
+        segment.unlink()
@@ -0,0 +1,105 @@
+import contextlib
+import ctypes
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+from . import processes
+
+# Every stage that can be recorded, so that a record only stores the index of its name.
+STAGES = (
+    "base.queue",
+    "base.slice",
+    "base.window",
+    "base.resize",
+    "over.queue",
+    "over.edit",
+    "over.slice",
+    "over.colorize",
+    "over.resize",
+    "main.base_frame",
+    "main.over_frame",
+    "main.base_latency",
+    "main.over_latency",
+)
+FIELDS = 5  # start, duration, stage, pid, queue depth
+
+
+class Ring:
+    """Fixed size buffer of stage timings in shared memory, written by the workers and read by Tk.
+
+    Times are `time.perf_counter()` seconds, which on Linux is the same monotonic clock in every
+    process. A ring of `capacity` 0 records nothing.
+    """
+
+    def __init__(self, capacity: int = 4096):
+        self.capacity = capacity
+        self._data = processes.context().RawArray(ctypes.c_double, max(capacity, 1) * FIELDS)
+        self._count = processes.context().Value(ctypes.c_long, 0)
+
+    def record(self, stage: str, start: float, duration: float, depth: int = -1):
+        if not self.capacity:
+            return
+        with self._count.get_lock():
+            slot = self._count.value % self.capacity
+            self._count.value += 1
+            self._data[slot * FIELDS:(slot + 1) * FIELDS] = [
+                start, duration, STAGES.index(stage), os.getpid(), depth]
+
+    @contextlib.contextmanager
+    def stage(self, stage: str, depth: int = -1):
+        start = time.perf_counter()
+        yield
+        self.record(stage, start, time.perf_counter() - start, depth)
+
+    def records(self) -> np.ndarray:
+        """The recorded rows, oldest first, as a (n, FIELDS) array."""
+        with self._count.get_lock():
+            count = self._count.value
+            data = np.frombuffer(self._data, dtype=np.float64).reshape(-1, FIELDS).copy()
+        if count <= self.capacity:
+            return data[:count]
+        return np.roll(data, -(count % self.capacity), axis=0)
+
+    def summary(self, window: float = 2.0) -> dict:
+        """Per stage count, p50 and p95 duration (ms) and last queue depth over the last `window` seconds."""
+        records = self.records()
+        records = records[records[:, 0] >= time.perf_counter() - window]
+        summary = {}
+        for index, stage in enumerate(STAGES):
+            rows = records[records[:, 2] == index]
+            if len(rows):
+                p50, p95 = np.percentile(rows[:, 1], [50, 95]) * 1000
+                summary[stage] = dict(count=len(rows), p50=p50, p95=p95, depth=int(rows[-1, 4]))
+        return summary
+
+    def dump(self, path: Path):
+        """Write the records as a Chrome trace (chrome://tracing, Perfetto), one row per process."""
+        events = [
+            dict(
+                name=STAGES[int(stage)],
+                ph="X",
+                ts=start * 1e6,
+                dur=duration * 1e6,
+                pid=int(pid),
+                tid=int(pid),
+                args=dict(queue=int(depth)),
+            )
+            for start, duration, stage, pid, depth in self.records()
+        ]
+        with open(path, "w") as f:
+            json.dump(dict(traceEvents=events), f)
+
+
+def depth(queue) -> int:
+    """Items waiting in `queue`, or -1 where multiprocessing cannot tell (macOS)."""
+    try:
+        return queue.qsize()
+    except NotImplementedError:
+        return -1
+
+
+OFF = Ring(0)
@@ -1,51 +1,40 @@
 import ctypes
+import itertools
 import multiprocessing
-import time
+import os
+import queue
 from pathlib import Path
-from typing import Literal
+from types import SimpleNamespace
 
 import numpy as np
 from PIL import Image
 
-from .shared_ndarray import SharedNdarray
+from . import processes, render
+from .brush import paint
+from .shared_ndarray import SharedBlock
 
 
-# from . import nibabel_utils
-
-
-class SliceGenWorker(object):
-    def __init__(self, *, queue, path, z):
-        self._is_alive = multiprocessing.Value(ctypes.c_bool, True)
-        self.i = 0
-        self.queue = queue
+class SliceGenWorker:
+    def __init__(self, *, path: Path, z: int):
         self.path = path
         self.z = z
 
-    def get_is_alive(self):
-        with self._is_alive.get_lock():
-            return self._is_alive.value
-
-    def set_is_alive(self, value):
-        with self._is_alive.get_lock():
-            self._is_alive.value = value
-
-    is_alive = property(get_is_alive, set_is_alive)
-
     def run(self):
-        data = nibabelio.load(self.path, scan=True, segm=True, clip=(0, 255))
+        from . import nibabel_utils
+        data = nibabel_utils.load(self.path, scan=True, segm=True, clip=(0, 255))
         scan = data["scan"]
-        slice = np.uint8(scan[2, :, :, self.z])
-        # slice = np.random.randint(0, 256, (512, 512)).astype(np.uint8)
-        self.queue.put(slice)
-        self.is_alive = False
+        return np.uint8(scan[2, :, :, self.z])
 
 
 class DrawBaseImageWorker:
-    def __init__(self, *, queue: multiprocessing.Queue, data: np.ndarray, z: int, resolution: int, phase: int,
-                 swap_xy: bool, flip_x: bool, flip_y: bool):
-        self._is_alive = multiprocessing.Value(ctypes.c_bool, True)
-        self.queue = queue
+    def __init__(self, *, data: SharedBlock, z: int, resolution: int, phase: int,
+                 swap_xy: bool, flip_x: bool, flip_y: bool, resample: str = "bicubic", box: tuple = None,
+                 window: tuple = None, plane: str = "axial"):
         self.data = data
+        self.plane = plane
+        self.window = window
+        self.resample = resample
+        self.box = box
         self.flip_x = flip_x
         self.flip_y = flip_y
         self.swap_xy = swap_xy
@@ -53,133 +42,169 @@ class DrawBaseImageWorker:
         self.z = z
         self.resolution = resolution
 
-    def get_is_alive(self):
-        with self._is_alive.get_lock():
-            return self._is_alive.value
-
-    def set_is_alive(self, value):
-        with self._is_alive.get_lock():
-            self._is_alive.value = value
-
-    is_alive = property(get_is_alive, set_is_alive)
-
     def run(self):
         if self.data is None:
             slice = np.random.randint(0, 256, (512, 512)).astype(np.uint8)
         else:
-            slice = np.uint8(self.data[self.phase, :, :, self.z])
-        if self.swap_xy:
-            slice = slice.transpose()
-        if self.flip_x:
-            slice = np.flip(slice, axis=0)
-        if self.flip_y:
-            slice = np.flip(slice, axis=1)
+            slice = render.plane(self.data.as_numpy[self.phase], self.plane, self.z)
+        slice = render.orient(slice, self.swap_xy, self.flip_x, self.flip_y)
+        slice, box = render.crop(slice, self.box)
+        # np.uint8 would wrap the int16 scan around: without a window, the default one clips it.
+        slice = render.apply_window(slice, self.window or render.WINDOW_PRESETS["Default"])
 
-        img = Image.fromarray(slice).convert('RGB').resize((self.resolution, self.resolution))
-        self.queue.put(img, timeout=4)
-        self.is_alive = False
+        return render.resize(Image.fromarray(slice).convert('RGB'), self.resolution, self.resample, box=box)
 
 
 class DrawOverImageWorker:
-    def __init__(self, *, queue: multiprocessing.Queue, data: SharedNdarray, z: int, resolution: int,
-                 swap_xy: bool, flip_x: bool, flip_y: bool):
-        self._is_alive = multiprocessing.Value(ctypes.c_bool, True)
-        self.queue = queue
+    def __init__(self, *, data: SharedBlock, z: int, resolution: int,
+                 swap_xy: bool, flip_x: bool, flip_y: bool, resample: str = "bicubic", box: tuple = None,
+                 plane: str = "axial"):
         self.shared_data = data
+        self.plane = plane
+        self.resample = resample
+        self.box = box
         self.flip_x = flip_x
         self.flip_y = flip_y
         self.swap_xy = swap_xy
         self.z = z
         self.resolution = resolution
 
-    def get_is_alive(self):
-        with self._is_alive.get_lock():
-            return self._is_alive.value
-
-    def set_is_alive(self, value):
-        with self._is_alive.get_lock():
-            self._is_alive.value = value
-
-    is_alive = property(get_is_alive, set_is_alive)
-
     def run(self):
         if self.shared_data is None:
             slice = np.random.randint(0, 3, (512, 512)).astype(np.uint8)
         else:
-            slice = np.uint8(self.shared_data.as_numpy[:, :, self.z])
-        if self.swap_xy:
-            slice = slice.transpose()
-        if self.flip_x:
-            slice = np.flip(slice, axis=0)
-        if self.flip_y:
-            slice = np.flip(slice, axis=1)
-
-        red = 255 * np.uint8(slice == 1)
-        green = 255 * np.uint8(slice == 2)
-        blue = 255 * np.uint8(slice == 0)
-        alpha = np.uint8(np.zeros_like(slice) + 255 * 0.6 * (slice > 0))
-
-        img = Image.fromarray(
-            np.stack([red, green, blue, alpha], axis=-1)
-        ).convert('RGBA').resize((self.resolution, self.resolution))
-        self.queue.put(img, timeout=4)
-        self.is_alive = False
+            slice = np.uint8(render.plane(self.shared_data.as_numpy, self.plane, self.z))
+        slice = render.orient(slice, self.swap_xy, self.flip_x, self.flip_y)
+        slice, box = render.crop(slice, self.box)
+
+        return render.resize(
+            Image.fromarray(render.colorize(slice)).convert('RGBA'), self.resolution, self.resample, box=box)
 
 
 class EditWorker:
-    def __init__(self, *, flag: multiprocessing.Value, call_stack):
-        self._is_alive = multiprocessing.Value(ctypes.c_bool, True)
-        self.flag = flag
+    def __init__(self, *, call_stack):
         self.call_stack = call_stack
         self.shared_data = call_stack[0][1]["data"]
 
-    def get_is_alive(self):
-        with self._is_alive.get_lock():
-            return self._is_alive.value
-
-    def set_is_alive(self, value):
-        with self._is_alive.get_lock():
-            self._is_alive.value = value
-
-    is_alive = property(get_is_alive, set_is_alive)
-
     def run(self):
         segm = self.shared_data.as_numpy
         for (args, kwargs) in self.call_stack:
             event = kwargs["event"]
-            scan_size = kwargs["scan_size"]
-            swap_xy = kwargs["swap_xy"]
-            flip_x = kwargs["flip_x"]
-            flip_y = kwargs["flip_y"]
-            action = kwargs["action"]
-            brush = kwargs["brush"]
-            r = kwargs["r"]
-            z = kwargs["z"]
-            canvas_size = event.widget.winfo_width(), event.widget.winfo_height()
-            n = max(*canvas_size) / scan_size
-            x, y = int(event.x / n), int(event.y / n)
-            if not swap_xy:
-                x, y = y, x
-            if not flip_x:
-                x = (scan_size - 1) - x
-            if not flip_y:
-                y = (scan_size - 1) - y
-            xa, xb, xo, ya, yb, yo = max(0, x - r - 1), min(x + r, scan_size), abs(min(0, x - r - 1)), max(0,
-                                                                                                           y - r - 1), min(
-                y + r, scan_size), abs(min(0, y - r - 1))
-
-            segm[xa:xb, ya:yb, z] = action(brush[xo:xo + xb - xa, yo:yo + yb - ya], segm[xa:xb, ya:yb, z])
-        self.shared_data.update(segm)
-        self.flag.value = True
-        self.is_alive = False
+            from_index, to_index = kwargs["action"] // 10, kwargs["action"] % 10
+            action = lambda b, s: s + (to_index - from_index) * b * (s == from_index)
+            # The segmentation is shared memory: editing the plane view in place is all it takes.
+            view = render.plane(segm, kwargs.get("plane", "axial"), kwargs["z"])
+            x, y = render.canvas_to_slice(event.x, event.y, event.canvas_size, max(view.shape), kwargs.get("box"))
+            row, col = render.unorient(y, x, view.shape, kwargs["swap_xy"], kwargs["flip_x"], kwargs["flip_y"])
+            paint(view, row, col, kwargs["brush"], action)
+        return True
+
+
+def serve(tasks: multiprocessing.Queue, done: multiprocessing.Queue, outputs: dict, is_alive,
+          released: multiprocessing.Queue):
+    """Loop of a pool process: run each task and route its result to the named output.
+
+    Between tasks, unmap the SharedBlock sent on `released`, that this process may have attached to.
+    """
+    while is_alive.value:
+        while True:
+            try:
+                released.get_nowait().close()
+            except queue.Empty:
+                break
+        try:
+            task = tasks.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        if task is None:
+            break
+        try:
+            result = task.worker_class(**task.kwargs).run()
+            output = outputs[task.output]
+            if hasattr(output, "put"):
+                output.put(result if task.output != "results" else (task.id, result), timeout=4)
+            else:
+                output.value = bool(result)
+        except Exception as err:
+            print(f"Task {task.id} ({task.worker_class.__name__}) failed.", err)
+        done.put(task.id)
+
+
+class WorkerPool:
+    """Long lived processes that run tasks, so that a task costs a queue round trip instead of a spawn.
+
+    A task is a worker class with keyword arguments: the pool process builds it and calls `run()`.
+    Queues and flags cannot travel through a queue, so the outputs are fixed at construction and
+    tasks name the one they report to: a queue gets the result, a flag is set to `bool(result)`.
+    Without an output, `(task_id, result)` goes to `self.results`. Large data should be passed as
+    SharedBlock, that pool processes attach to once and keep mapped until `forget`.
+    """
+
+    def __init__(self, outputs: dict = None, size: int = None):
+        ctx = processes.context()
+        self._is_alive = ctx.Value(ctypes.c_bool, True)
+        self._ids = itertools.count()
+        self.tasks = ctx.Queue()
+        self.done = ctx.Queue()
+        self.results = ctx.Queue()
+        self.outputs = dict(outputs or {}, results=self.results)
+        self.finished = set()
+        # One queue per process, so that every process gets each release.
+        self._released = [ctx.Queue() for _ in range(size or max(1, min(4, (os.cpu_count() or 2) - 1)))]
+        self._processes = [
+            ctx.Process(
+                target=serve, args=(self.tasks, self.done, self.outputs, self._is_alive, released), daemon=True)
+            for released in self._released
+        ]
+        for process in self._processes:
+            process.start()
+
+    def submit(self, worker_class, output: str = "results", **kwargs) -> int:
+        task = SimpleNamespace(id=next(self._ids), worker_class=worker_class, output=output, kwargs=kwargs)
+        self.tasks.put(task)
+        return task.id
+
+    def forget(self, block: SharedBlock):
+        """Have every pool process unmap `block` before its next task."""
+        for released in self._released:
+            released.put(block)
+
+    def unlink(self, block: SharedBlock):
+        """Free `block`: the pool processes unmap it too, so that its memory is returned."""
+        self.forget(block)
+        block.unlink()
+
+    def collect(self):
+        while True:
+            try:
+                self.finished.add(self.done.get_nowait())
+            except queue.Empty:
+                break
+
+    def is_done(self, task_id: int) -> bool:
+        self.collect()
+        if task_id in self.finished:
+            self.finished.discard(task_id)
+            return True
+        return False
+
+    def stop(self):
+        for _ in self._processes:
+            self.tasks.put(None)
+        for process in self._processes:
+            process.join(timeout=2)
+        with self._is_alive.get_lock():
+            self._is_alive.value = False
 
 
 class ReplacementHandler:
-    def __init__(self, return_queue: multiprocessing.Queue, worker_class):
-        self.worker = None
+    """Runs only the latest scheduled call, waiting for the previous one to finish."""
+
+    def __init__(self, pool: WorkerPool, output: str, worker_class):
+        self.pool = pool
+        self.output = output
         self.worker_class = worker_class
-        self.process = None
-        self.return_queue = return_queue
+        self.task_id = None
         self.next_call = None
 
     def __delete__(self):
@@ -187,94 +212,51 @@ class ReplacementHandler:
 
     def schedule(self, *args, **kwargs):
         self.next_call = (args, kwargs)
-        # if self.worker and self.worker.is_alive:
-        #     self.scheduled = True
-        #     self.next_args = args
-        #     self.next_kwargs = kwargs
-        # else:
-        #     self.stop()
-        #     self.scheduled = False
-        #     self.worker = self.worker_class(*args, queue=self.return_queue, **kwargs)
-        #     self.process = multiprocessing.Process(target=self.worker.run)
-        #     self.process.start()
 
     def wake(self):
-        # print("-- wake? --")
-        if self.next_call and (self.worker is None or not self.worker.is_alive):
-            # print("-- wake! --")
-            self.stop()
+        if self.next_call and not self.is_alive:
             args, kwargs = self.next_call
             self.next_call = None
-            self.worker = self.worker_class(*args, queue=self.return_queue, **kwargs)
-            self.process = multiprocessing.Process(target=self.worker.run)
-            self.process.start()
+            self.task_id = self.pool.submit(self.worker_class, self.output, **kwargs)
 
     def stop(self):
-        if self.is_alive:
-            self.worker.is_alive = False
-            self.process.join(timeout=0.5)
-            # try:
-            #    self.process.close()
-            # except ValueError:
-            #    self.process.terminate()
-            self.worker = None
-            self.process = None
+        self.next_call = None
 
     def get_is_alive(self):
-        return bool(self.worker and self.process)
+        if self.task_id is not None and self.pool.is_done(self.task_id):
+            self.task_id = None
+        return self.task_id is not None
 
     is_alive = property(get_is_alive)
 
 
 class QueueHandler:
-    def __init__(self, flag: multiprocessing.Value, worker_class):
-        self.worker = None
+    """Runs all scheduled calls, in order, as one batch per task."""
+
+    def __init__(self, pool: WorkerPool, output: str, worker_class):
+        self.pool = pool
+        self.output = output
         self.worker_class = worker_class
-        self.process = None
-        self.flag = flag
+        self.task_id = None
         self.next_calls = []
 
     def __delete__(self):
         self.stop()
 
     def schedule(self, *args, **kwargs):
-        # print(" ** scheduled", args, kwargs)
         self.next_calls.append((args, kwargs))
-        # if self.worker and self.worker.is_alive:
-        #     self.scheduled = True
-        #     self.next_args = args
-        #     self.next_kwargs = kwargs
-        # else:
-        #     self.stop()
-        #     self.scheduled = False
-        #     self.worker = self.worker_class(*args, queue=self.return_queue, **kwargs)
-        #     self.process = multiprocessing.Process(target=self.worker.run)
-        #     self.process.start()
 
     def wake(self):
-        try:
-            assert self.worker is None or not self.worker.is_alive
-            assert self.next_calls
-            self.worker = self.worker_class(flag=self.flag, call_stack=self.next_calls)
-            self.process = multiprocessing.Process(target=self.worker.run)
-            self.process.start()
+        if self.next_calls and not self.is_alive:
+            self.task_id = self.pool.submit(self.worker_class, self.output, call_stack=self.next_calls)
             self.next_calls = []
-        except (AttributeError, AssertionError, IndexError) as err:
-            pass
 
     def stop(self):
         pass
-        # if self.is_alive:
-        #     self.worker.is_alive = False
-        #     self.process.join(timeout=0.5)
-        #     #try:
-        #     #    self.process.close()
-        #     #except ValueError:
-        #     #    self.process.terminate()
-        #     self.worker = None
-        #     self.process = None
 
     def get_is_alive(self):
-        return bool(self.worker and self.process)
+        if self.task_id is not None and self.pool.is_done(self.task_id):
+            self.task_id = None
+        return self.task_id is not None
 
     is_alive = property(get_is_alive)